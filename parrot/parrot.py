@@ -4,6 +4,10 @@ import random
 import asyncio
 import copy
 import datetime
+import functools
+import time
+import heapq
+import collections.abc
 
 import discord
 from discord.ext import commands
@@ -13,13 +17,15 @@ from .utils.dataIO import dataIO
 
 
 SAVE_FILEPATH = "data/KeaneCogs/parrot/parrot.json"
+SERVERS_DIRPATH = "data/KeaneCogs/parrot/servers" # one file per server, named by server ID
 
 SAVE_DEFAULT = {
-    "Servers": {},
     "Global": {
         "StarveTime": [5, 0], # the hour and minute of the day that starve_check runs
         "PerchInterval": 20, # the number of minutes between perches
-        "Version": "2.3"
+        "ChunkSize": 500, # servers processed before passes over every server yield to the event loop
+        "WarningRound": 0, # increased when every server's starvation warning is reset
+        "Version": "3.2"
     }
 }
 
@@ -29,7 +35,7 @@ SERVER_DEFAULT = {
 
         "ChecksAlive": 0, # number of starve_checks survived
 
-        "HoursAlive": 0, # number of hours Parrot has been alive in the server
+        "Born": 0, # UNIX time when Parrot joined the server (set by add_server)
 
         "UserWith": "", # ID of user Parrot is perched on (reset by starve_check)
 
@@ -39,13 +45,23 @@ SERVER_DEFAULT = {
 
         "StarvedLoops": 0, # phase of starvation Parrot is in
 
-        "WarnedYet": False, # whether the server has been warned for the current self.checktime
+        "WarnedRound": -1, # the WarningRound the server was last warned in
 
         "StealAvailable": True # whether steal is available for the perched user (reset by perch_loop)
     },
     "Feeders": {} # contains user IDs as keys and dicts as values (reset by starve_check)
 }
 
+SAVE_INTERVAL = 10 # seconds between writes of a changed save file
+SAVE_CHUNK_SIZE = 20 # server files written before saving yields to the event loop
+
+FAN_OUT_CONCURRENCY = 20 # most Discord requests fan_out has in flight at once
+FAN_OUT_RETRIES = 3 # attempts per server when Discord rate limits a request
+FAN_OUT_BACKOFF = 2 # seconds; doubled after each rate limited attempt
+
+CREDIT_GROWTH = 1.003 # how much faster Parrot collects credits each minute after checktime
+CREDIT_DAY_TOTAL = 24568 # about the sum of CREDIT_GROWTH**minute over a day's 1440 minutes
+
 FEEDER_DEFAULT = {
     "PelletsFed": 0,
     "HeistBoostAvailable": True,
@@ -54,20 +70,122 @@ FEEDER_DEFAULT = {
     "CreditsCollected": 0.0
 }
 
+def perch_multiplier(minute, interval):
+    """Return the fraction of a day's credits that Parrot collects during
+    a perch of interval minutes starting minute minutes after checktime.
+
+    This is the sum of CREDIT_GROWTH**i for i from minute to
+    minute + interval - 1, worked out as a geometric series."""
+    return (CREDIT_GROWTH**minute * (CREDIT_GROWTH**interval - 1)
+            / (CREDIT_GROWTH - 1) / CREDIT_DAY_TOTAL)
+
+class ServerStore(collections.abc.MutableMapping):
+    """The data of every server, kept as one file per server. This is
+    self.save_file["Servers"]. A server's file is read the first time its
+    data is used, and only the files of servers marked as changed are
+    written when the store is saved."""
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.ids = {filename[:-5] for filename in os.listdir(dirpath)
+                    if filename.endswith(".json")}
+        self.loaded = {} # server IDs as keys and server data as values
+        self.changed = set() # IDs of servers to write
+        self.removed = set() # IDs of servers whose files should be deleted
+
+    def filepath(self, serverid):
+        return os.path.join(self.dirpath, serverid + ".json")
+
+    def __getitem__(self, serverid):
+        if serverid not in self.loaded:
+            if serverid not in self.ids:
+                raise KeyError(serverid)
+            self.loaded[serverid] = dataIO.load_json(self.filepath(serverid))
+        return self.loaded[serverid]
+
+    def __setitem__(self, serverid, data):
+        self.ids.add(serverid)
+        self.loaded[serverid] = data
+        self.changed.add(serverid)
+        self.removed.discard(serverid)
+
+    def __delitem__(self, serverid):
+        self.ids.remove(serverid)
+        self.loaded.pop(serverid, None)
+        self.changed.discard(serverid)
+        self.removed.add(serverid)
+
+    def __contains__(self, serverid):
+        return serverid in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def mark(self, serverid=None):
+        """Mark a server as changed. With no server ID, mark every loaded
+        server, since servers that haven't been loaded can't have changed.
+        A server that has been removed, for example while a command was
+        waiting, is ignored."""
+        if serverid is None:
+            self.changed.update(self.loaded)
+        elif serverid in self.loaded:
+            self.changed.add(serverid)
+
+    def pending(self):
+        """Return a list of the IDs of servers whose files need to be
+        written or deleted."""
+        return list(self.changed | self.removed)
+
+    def save_server(self, serverid):
+        """Write a changed server's file or delete a removed server's file.
+        Return the path if a file was written, or None."""
+        if serverid in self.changed:
+            self.changed.discard(serverid)
+            dataIO.save_json(self.filepath(serverid), self.loaded[serverid])
+            return self.filepath(serverid)
+        if serverid in self.removed:
+            self.removed.discard(serverid)
+            if os.path.exists(self.filepath(serverid)):
+                os.remove(self.filepath(serverid))
+        return None
+
+    def save(self):
+        """Write the files of changed servers and delete the files of removed
+        servers. Return a list of the paths that were written."""
+        written = []
+        for serverid in self.pending():
+            filepath = self.save_server(serverid)
+            if filepath is not None:
+                written.append(filepath)
+        return written
+
 class Parrot:
     """Commands related to feeding the bot."""
 
     def __init__(self, bot):
-        self.save_file = dataIO.load_json(SAVE_FILEPATH)
         self.bot = bot
 
-        self.update_version()
+        # The save file is written by self.save_loop() after it is marked dirty
+        self.dirty = False
+        self.saves = 0 # number of times the save file has been written
+        self.bytes_saved = 0 # total size of those writes
+        self.save_seconds = 0 # total time spent writing
+
+        self.fan_out_stats = {} # names of fan_out runs as keys and their latest progress as values
+
+        self.load_files()
 
         self.checktime = datetime.datetime.utcnow() # dummy value
         self.perchtime = datetime.datetime.utcnow() # dummy value
+        self.warned_for = None # the checktime that warnings were last sent for
+        self.timers = [] # heap of (time, task) for the loop, built by self.schedule()
+        self.wake = asyncio.Event() # set to make the loop reschedule
         self.update_looptimes(False) # change checktime to what it should be
                                      # without causing a new warning
-        self.loop_task = bot.loop.create_task(self.loop()) # remember to change __unload()
+        self.start_tasks()
 
     @commands.command(pass_context=True, no_pm=True)
     async def feed(self, ctx, amount: int):
@@ -127,7 +245,7 @@ class Parrot:
         # change parrot's fullness level
         parrot["Fullness"] += amount
 
-        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+        self.mark_dirty(server.id)
         return await self.bot.say("Om nom nom. Thanks!")
 
     @commands.group(pass_context=True)
@@ -176,7 +294,7 @@ class Parrot:
             return await self.bot.say("Setting change cancelled.")
 
         self.save_file["Global"]["StarveTime"] = [hour, minute]
-        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+        self.mark_dirty()
         self.update_looptimes()
         return await self.bot.say("Setting change successful.")
 
@@ -204,7 +322,7 @@ class Parrot:
             return await self.bot.say("Setting change cancelled.")
 
         self.save_file["Global"]["PerchInterval"] = minutes
-        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+        self.mark_dirty()
         self.update_looptimes() # this updates self.perchtime with the new interval
         return await self.bot.say("Setting change successful.")
 
@@ -217,6 +335,40 @@ class Parrot:
         return await self.bot.send_message(ctx.message.author,
                                            "starve_check was executed.")
 
+    @parrot.command(name="diagnostics", pass_context=True) # no_pm=False
+    @checks.is_owner()
+    async def parrot_diagnostics(self, ctx):
+        """Show how often the save file has been written since Parrot was
+        loaded, and how the latest messages to every server went."""
+        report = ("{} saves, {:.1f} KB written, {:.1f} ms spent writing\n"
+                  "Unsaved changes: {}\n"
+                  .format(self.saves, self.bytes_saved / 1024, self.save_seconds * 1000,
+                          "yes" if self.dirty or self.save_file["Servers"].changed else "no"))
+        for name, stats in self.fan_out_stats.items():
+            if stats["Seconds"] is None:
+                seconds = time.monotonic() - stats["Started"] # still running
+            else:
+                seconds = stats["Seconds"]
+            report += ("{}: {}/{} done, {} failed, {} retries, {:.1f} s\n"
+                       .format(name, stats["Done"], stats["Total"], stats["Failed"],
+                               stats["Retries"], seconds))
+        return await self.bot.say("```\n{}```".format(report))
+
+    @parrot.command(name="chunksize", pass_context=True) # no_pm=False
+    @checks.is_owner()
+    async def parrot_chunk_size(self, ctx, servers: int = None):
+        """View or change how many servers Parrot handles at a time before
+        letting the bot do other work during a perch or starve check."""
+        if servers is None:
+            chunk_size = self.save_file["Global"]["ChunkSize"]
+            return await self.bot.say("Current setting: {} servers".format(chunk_size))
+        if servers <= 0:
+            return await self.bot.say("The number of servers must be greater than 0.")
+
+        self.save_file["Global"]["ChunkSize"] = servers
+        self.mark_dirty()
+        return await self.bot.say("Setting change successful.")
+
     @parrot.command(name="setcost", pass_context=True, no_pm=True)
     @checks.admin_or_permissions(manage_server=True)
     async def parrot_set_cost(self, ctx, cost: int):
@@ -225,7 +377,7 @@ class Parrot:
         self.add_server(server) # make sure the server is in the data file
         if cost >= 0:
             self.save_file["Servers"][server.id]["Parrot"]["Cost"] = cost
-            dataIO.save_json(SAVE_FILEPATH, self.save_file)
+            self.mark_dirty(server.id)
             return await self.bot.say("Set cost of feeding to {} credits per pellet.".format(cost))
         else:
             return await self.bot.say("Cost must be at least 0.")
@@ -282,7 +434,7 @@ class Parrot:
 
         parrot["StealAvailable"] = False
         feeders[ctx.message.author.id]["StolenFrom"].append(target.id)
-        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+        self.mark_dirty(ctx.message.server.id)
         return await self.bot.say(msg)
 
     @parrot.command(name="airhorn", pass_context=True, no_pm=True)
@@ -374,7 +526,7 @@ class Parrot:
         audio._add_to_queue(server, url)
 
         self.save_file["Servers"][server.id]["Feeders"][ctx.message.author.id]["AirhornUses"] += 1 # NEW
-        dataIO.save_json(SAVE_FILEPATH, self.save_file) # NEW
+        self.mark_dirty(server.id) # NEW
 
     @parrot.command(name="info", pass_context=True, no_pm=True, aliases=["stats"])
     async def parrot_info(self, ctx):
@@ -386,7 +538,7 @@ class Parrot:
 
         fullness_str = "{} out of {} pellets".format(parrot["Fullness"], parrot["Appetite"])
         feed_cost_str = "{} credits per pellet".format(parrot["Cost"])
-        days_living_str = "{} days".format(round(parrot["HoursAlive"] / 24))
+        days_living_str = "{} days".format(round((time.time() - parrot["Born"]) / 86400))
 
         # status and time_until_starved
         if parrot["StarvedLoops"] == 0:
@@ -501,151 +653,230 @@ class Parrot:
         return await self.bot.say(output)
 
     async def loop(self):
-        """Loop forever to do four tasks:
+        """Loop forever to do three tasks:
+
+        Warn servers when Parrot is starving soon, perch on users
+        at perchtime, and reset Parrot at checktime.
 
-        Update HoursAlive, warn servers when Parrot is starving soon,
-        perch on users at perchtime, and reset Parrot at checktime."""
+        The loop sleeps until the next task in self.timers is due, or until
+        self.wake is set because the loop times have changed."""
         await self.bot.wait_until_ready()
 
         self.update_looptimes()
-        current_hour = datetime.datetime.utcnow().hour
         while True:
             now = datetime.datetime.utcnow()
+            due = set()
+            while self.timers and self.timers[0][0] <= now:
+                due.add(heapq.heappop(self.timers)[1])
+
+            if "warn" in due:
+                await self.send_warnings()
+            if "perch" in due:
+                await self.perch()
+
+            self.schedule()
+            self.wake.clear()
+            delay = (self.timers[0][0] - datetime.datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def schedule(self):
+        """Rebuild self.timers, the queue of (time, task) that the loop sleeps
+        on, from the loop times. Wake the loop so that it sleeps until the
+        right time."""
+        self.timers = [(self.perchtime, "perch")]
+        if self.warned_for != self.checktime: # warnings haven't been sent for this checktime
+            self.timers.append((self.checktime + datetime.timedelta(hours=-4), "warn"))
+        heapq.heapify(self.timers)
+        self.wake.set()
+
+    async def send_warnings(self):
+        """Send starvation warnings to each server (if they haven't been sent yet)."""
+        self.warned_for = self.checktime
+        warning_round = self.save_file["Global"]["WarningRound"]
+        warnings = []
+        for index, serverid in enumerate(list(self.save_file["Servers"])):
+            await self.pause(index)
+            if serverid not in self.save_file["Servers"]: # removed while paused
+                continue
+            parrot = self.save_file["Servers"][serverid]["Parrot"]
+            if (parrot["ChecksAlive"] > 0
+                    and (parrot["Fullness"] / parrot["Appetite"]) < 0.5
+                    and parrot["WarnedRound"] != warning_round):
+
+                if parrot["StarvedLoops"] == 0:
+                    warning = "*I'm quite hungry...*"
+                elif parrot["StarvedLoops"] == 1:
+                    warning = "*I'm so hungry I feel weak...*"
+                else:
+                    warning = ("*I'm going to* ***DIE*** *of starvation very "
+                               "soon if I don't get fed!*")
+                warnings.append((serverid, functools.partial(
+                    self.bot.send_message, self.bot.get_server(serverid), warning)))
+                parrot["WarnedRound"] = warning_round
+                self.mark_dirty(serverid)
+        if warnings:
+            await self.fan_out("warnings", warnings)
+
+    async def perch(self):
+        """Perch on users, reset Parrot if it is checktime, and collect
+        credits for the perched users."""
+        now = datetime.datetime.utcnow()
+
+        # Choose perched user. The choices are made in chunks and then
+        # applied all at once, so no command sees a half-finished perch.
+        chosen = [] # (server ID, ID of the chosen user or "")
+        for index, serverid in enumerate(list(self.save_file["Servers"])):
+            await self.pause(index)
+            if serverid not in self.save_file["Servers"]: # removed while paused
+                continue
+            feeders = self.save_file["Servers"][serverid]["Feeders"]
+            parrot = self.save_file["Servers"][serverid]["Parrot"]
 
-            # Update HoursAlive
-            if current_hour != now.hour:
-                current_hour = now.hour
-                for serverid in self.save_file["Servers"]:
-                    self.save_file["Servers"][serverid]["Parrot"]["HoursAlive"] += 1
-
-                dataIO.save_json(SAVE_FILEPATH, self.save_file)
-
-            # Send starvation warnings to each server (if they haven't been sent yet)
-            stoptime = self.checktime + datetime.timedelta(hours=-4)
-            if stoptime <= now:
-                change = False
-                for serverid in self.save_file["Servers"]:
-                    parrot = self.save_file["Servers"][serverid]["Parrot"]
-                    if (parrot["ChecksAlive"] > 0
-                            and (parrot["Fullness"] / parrot["Appetite"]) < 0.5
-                            and not parrot["WarnedYet"]):
-
-                        if parrot["StarvedLoops"] == 0:
-                            await self.bot.send_message(
-                                self.bot.get_server(serverid),
-                                "*I'm quite hungry...*")
-                        elif parrot["StarvedLoops"] == 1:
-                            await self.bot.send_message(
-                                self.bot.get_server(serverid),
-                                "*I'm so hungry I feel weak...*")
-                        else:
-                            await self.bot.send_message(
-                                self.bot.get_server(serverid),
-                                "*I'm going to* ***DIE*** *of starvation very "
-                                "soon if I don't get fed!*")
-                        parrot["WarnedYet"] = True
-                        change = True
-                if change:
-                    dataIO.save_json(SAVE_FILEPATH, self.save_file)
-
-            # Perch
-            if self.perchtime <= now:
-                # Choose perched user
-                for serverid in self.save_file["Servers"]:
-                    feeders = self.save_file["Servers"][serverid]["Feeders"]
-                    parrot = self.save_file["Servers"][serverid]["Parrot"]
-
-                    weights = [(feeders[feederid]["PelletsFed"] / parrot["Appetite"])
-                               * 100 for feederid in feeders]
-                    population = list(feeders)
-                    weights.append(100 - sum(weights))
-                    population.append("")
-                    # Randomly choose who Parrot is with. This could be nobody, represented by ""
-                    try:
-                        parrot["UserWith"] = random.choices(population, weights)[0] #random.choices returns a list
-                    except AttributeError:
-                        # DIY random.choices alternative for scrubs who don't have Python 3.6
-                        total = 0
-                        cum_weights = []
-                        for num in weights:
-                            total += num
-                            cum_weights.append(total)
-
-                        rand = random.uniform(0, 100)
-                        for index, weight in enumerate(cum_weights):
-                            if weight >= rand:
-                                parrot["UserWith"] = population[index]
-                                break
-
-                # Reset at checktime (checktime is always on a perchtime)
-                if self.checktime <= now:
-                    await self.display_collected()
-                    await self.starve_check()
-                    self.update_looptimes() # checktime must be updated daily
-
-                # Collect coins for perched user
-                for serverid in self.save_file["Servers"]:
-                    self.collect_credits(serverid)
-                    self.save_file["Servers"][serverid]["Parrot"]["StealAvailable"] = True
-
-                # Update perchtime
-                interval = self.save_file["Global"]["PerchInterval"]
-                self.perchtime = self.perchtime + datetime.timedelta(minutes=interval)
-
-                dataIO.save_json(SAVE_FILEPATH, self.save_file)
-
-            await asyncio.sleep(1)
+            weights = [(feeders[feederid]["PelletsFed"] / parrot["Appetite"])
+                       * 100 for feederid in feeders]
+            population = list(feeders)
+            weights.append(100 - sum(weights))
+            population.append("")
+            # Randomly choose who Parrot is with. This could be nobody, represented by ""
+            try:
+                chosen.append((serverid, random.choices(population, weights)[0])) #random.choices returns a list
+            except AttributeError:
+                # DIY random.choices alternative for scrubs who don't have Python 3.6
+                total = 0
+                cum_weights = []
+                for num in weights:
+                    total += num
+                    cum_weights.append(total)
+
+                rand = random.uniform(0, 100)
+                for position, weight in enumerate(cum_weights):
+                    if weight >= rand:
+                        chosen.append((serverid, population[position]))
+                        break
+                else:
+                    chosen.append((serverid, ""))
+
+        for serverid, userwith in chosen:
+            if serverid not in self.save_file["Servers"]: # removed while paused
+                continue
+            parrot = self.save_file["Servers"][serverid]["Parrot"]
+            if parrot["UserWith"] != userwith:
+                parrot["UserWith"] = userwith
+                self.mark_dirty(serverid)
+
+        # Reset at checktime (checktime is always on a perchtime)
+        if self.checktime <= now:
+            await self.display_collected()
+            await self.starve_check()
+            self.update_looptimes() # checktime must be updated daily
+
+        # Collect coins for perched user. Only this loop uses
+        # CreditsCollected, so it's safe to pause between servers.
+        multiplier = self.perch_multiplier() # the same for every server
+        for index, serverid in enumerate(list(self.save_file["Servers"])):
+            await self.pause(index)
+            if serverid not in self.save_file["Servers"]: # removed while paused
+                continue
+            changed = self.collect_credits(serverid, multiplier)
+            parrot = self.save_file["Servers"][serverid]["Parrot"]
+            if not parrot["StealAvailable"]:
+                parrot["StealAvailable"] = True
+                changed = True
+            if changed: # only servers that changed are written
+                self.mark_dirty(serverid)
+
+        # Update perchtime
+        interval = self.save_file["Global"]["PerchInterval"]
+        self.perchtime = self.perchtime + datetime.timedelta(minutes=interval)
 
     async def starve_check(self):
         """Check if Parrot has starved or not.
         If Parrot has starved, leave the server. If he has survived,
         reset for the next loop."""
-        for serverid in list(self.save_file["Servers"]): # generate a list because servers might
-                                                         # be removed from the dict while iterating
-            parrot = self.save_file["Servers"][serverid]["Parrot"]
-            feeders = self.save_file["Servers"][serverid]["Feeders"]
+        # Copy new feeder data for every server in chunks, since copying
+        # takes most of the time, then check and change every server at
+        # once, so no command sees a half-finished check and a feed during
+        # a pause still counts.
+        new_feeders = {} # server IDs as keys and new feeder data as values
+        for index, serverid in enumerate(list(self.save_file["Servers"])):
+            await self.pause(index)
+            new_feeders[serverid] = copy.deepcopy(FEEDER_DEFAULT)
+
+        deaths = []
+        goodbyes = set() # IDs of dead servers that have been said goodbye to
+        servers = self.save_file["Servers"]
+        for serverid in list(servers):
+            server_data = servers[serverid]
+            parrot = server_data["Parrot"]
 
             # don't check on the first loop to give new servers a chance
             # in case they got added at an unlucky time (right before the check happens)
-            reset = False
             if parrot["ChecksAlive"] == 0:
                 parrot["ChecksAlive"] += 1
-            elif parrot["Fullness"] / parrot["Appetite"] < 0.5:
-                if parrot["StarvedLoops"] == 2:
-                    await self.bot.send_message(
-                        self.bot.get_server(serverid),
-                        "Oh no! I've starved to death!\n"
-                        "Goodbye, cruel world!")
-                    await self.bot.leave_server(self.bot.get_server(serverid))
-                    del self.save_file["Servers"][serverid]
+                self.mark_dirty(serverid)
+                continue
 
-                else:
-                    # advance to the next stage of starvation
-                    parrot["StarvedLoops"] += 1
-                    reset = True
+            if parrot["Fullness"] / parrot["Appetite"] < 0.5:
+                if parrot["StarvedLoops"] == 2:
+                    deaths.append((serverid, functools.partial(self.die, serverid, goodbyes)))
+                    del servers[serverid]
+                    continue
+                # advance to the next stage of starvation
+                parrot["StarvedLoops"] += 1
             else:
                 # healthy; reset for the next loop
                 parrot["StarvedLoops"] = 0
-                reset = True
-
-            if reset:
-                parrot["ChecksAlive"] += 1
-                parrot["Appetite"] = round(random.normalvariate(50*(1.75**parrot["StarvedLoops"]), 6))
-                parrot["Fullness"] = 0
-                parrot["WarnedYet"] = False
-                self.save_file["Servers"][serverid]["Feeders"].clear()
-                # https://stackoverflow.com/questions/369898/difference-between-dict-clear-and-assigning-in-python
-                if parrot["UserWith"]:
-                    feeders[parrot["UserWith"]] = copy.deepcopy(FEEDER_DEFAULT)
-
-        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+            parrot["ChecksAlive"] += 1
+            parrot["Appetite"] = round(random.normalvariate(50*(1.75**parrot["StarvedLoops"]), 6))
+            parrot["Fullness"] = 0
+            parrot["WarnedRound"] = -1
+            feeders = server_data["Feeders"]
+            feeders.clear()
+            # https://stackoverflow.com/questions/369898/difference-between-dict-clear-and-assigning-in-python
+            if parrot["UserWith"]:
+                # a server added while paused has no copy yet
+                feeders[parrot["UserWith"]] = new_feeders.get(
+                    serverid) or copy.deepcopy(FEEDER_DEFAULT)
+            self.mark_dirty(serverid)
+
+        await self.fan_out("deaths", deaths)
+
+    async def die(self, serverid, goodbyes):
+        """Say goodbye to a server and leave it. The server is left even if
+        the goodbye can't be sent, since its data is already deleted.
+        goodbyes is a set of the IDs of servers that have been said goodbye
+        to, so that a retried leave doesn't say it again."""
+        server = self.bot.get_server(serverid)
+        if server is None:
+            return # the bot isn't in the server anymore
+        if server.id not in goodbyes:
+            goodbyes.add(server.id)
+            try:
+                await self.bot.send_message(server, "Oh no! I've starved to death!\n"
+                                                    "Goodbye, cruel world!")
+            except discord.HTTPException as error:
+                print("Parrot couldn't say goodbye to server {}: {}".format(server.id, error))
+        await self.bot.leave_server(server)
 
     async def display_collected(self):
         """Display a leaderboard in each server with how many credits
-        Parrot collected for users. Award CreditsCollected to each feeder."""
+        Parrot collected for users. Award CreditsCollected to each feeder.
+
+        Each server is paid all at once between pauses, and starve_check
+        only resets CreditsCollected after every server has been paid."""
         bank = self.bot.get_cog('Economy').bank
-        for serverid in self.save_file["Servers"]:
+        leaderboards = []
+        for index, serverid in enumerate(list(self.save_file["Servers"])):
+            await self.pause(index)
+            if serverid not in self.save_file["Servers"]: # removed while paused
+                continue
             server = self.bot.get_server(serverid)
+            if server is None:
+                continue # the bot isn't in the server anymore
             leaderboard = ("Here's how many credits I collected for "
                            "everyone I perched on today:\n\n")
             leaderboard += "```py\n"
@@ -672,14 +903,69 @@ class Parrot:
                 leaderboard += " " * (26 - len(name) - len(str(collected)))
                 leaderboard += str(collected) + "\n"
             leaderboard += "```"
-            await self.bot.send_message(server, leaderboard)
+            leaderboards.append((serverid, functools.partial(
+                self.bot.send_message, server, leaderboard)))
+        await self.fan_out("leaderboards", leaderboards)
+
+    async def fan_out(self, name, calls):
+        """Make a Discord request for many servers at once. calls is a list of
+        (server ID, function that returns an awaitable request).
+
+        At most FAN_OUT_CONCURRENCY requests run at a time. A request that
+        fails only affects its own server, and a rate limited request is
+        retried. Progress is kept in self.fan_out_stats[name].
+
+        The requests are shared out between FAN_OUT_CONCURRENCY workers
+        rather than each getting a task, which would take a long time to
+        set up for many servers."""
+        stats = {"Total": len(calls), "Done": 0, "Failed": 0, "Retries": 0,
+                 "Started": time.monotonic(), "Seconds": None}
+        self.fan_out_stats[name] = stats
+        remaining = iter(calls)
+
+        async def run(serverid, call):
+            for attempt in range(FAN_OUT_RETRIES):
+                if attempt:
+                    stats["Retries"] += 1
+                    await asyncio.sleep(FAN_OUT_BACKOFF * 2**(attempt - 1))
+                try:
+                    await call()
+                except discord.HTTPException as error:
+                    failure = error
+                    if getattr(error.response, "status", None) != 429:
+                        break
+                except Exception as error: # keep one server from stopping the rest
+                    failure = error
+                    break
+                else:
+                    stats["Done"] += 1
+                    return
+            stats["Failed"] += 1
+            print("Parrot {} failed for server {}: {}".format(name, serverid, failure))
+
+        async def worker():
+            for serverid, call in remaining:
+                await run(serverid, call)
+
+        await asyncio.gather(*[worker() for _ in range(FAN_OUT_CONCURRENCY)])
+        stats["Seconds"] = time.monotonic() - stats["Started"]
+
+    async def pause(self, index, chunk_size=None):
+        """Yield to the event loop once every chunk_size servers of a pass
+        over every server, so that the pass doesn't block the bot. chunk_size
+        is the ChunkSize setting by default."""
+        if chunk_size is None:
+            chunk_size = self.save_file["Global"]["ChunkSize"]
+        if index % chunk_size == 0 and index:
+            await asyncio.sleep(0)
 
     def add_server(self, server):
         """Add the server to the file if it isn't already in it."""
         if server.id not in self.save_file["Servers"]:
             self.save_file["Servers"][server.id] = copy.deepcopy(SERVER_DEFAULT)
             self.save_file["Servers"][server.id]["Parrot"]["Appetite"] = round(random.normalvariate(50, 6))
-            dataIO.save_json(SAVE_FILEPATH, self.save_file)
+            self.save_file["Servers"][server.id]["Parrot"]["Born"] = time.time()
+            self.mark_dirty(server.id)
             print("{} New server \"{}\" found and added to Parrot data file!"
                   .format(datetime.datetime.now(), server.name))
 
@@ -701,9 +987,9 @@ class Parrot:
                                         # initial value)
             self.checktime = checktime
             if warn:
-                for serverid in self.save_file["Servers"]:
-                    self.save_file["Servers"][serverid]["Parrot"]["WarnedYet"] = False
-                dataIO.save_json(SAVE_FILEPATH, self.save_file)
+                # every server counts as unwarned in a new round
+                self.save_file["Global"]["WarningRound"] += 1
+                self.mark_dirty()
 
         # Update self.perchtime
         interval = self.save_file["Global"]["PerchInterval"]
@@ -711,21 +997,24 @@ class Parrot:
         while self.perchtime < datetime.datetime.utcnow():
             self.perchtime = self.perchtime + datetime.timedelta(minutes=interval)
 
-    def collect_credits(self, serverid):
-        """Calculate how many credits Parrot will collect during the perch."""
-        parrot = self.save_file["Servers"][serverid]["Parrot"]
-        feeders = self.save_file["Servers"][serverid]["Feeders"]
-        interval = self.save_file["Global"]["PerchInterval"]
+        self.schedule() # the loop may need to wake at a different time
 
-        # Generate multiplier
+    def perch_multiplier(self):
+        """Calculate the multiplier for the credits collected during the current perch."""
+        interval = self.save_file["Global"]["PerchInterval"]
         since_checktime = datetime.datetime.utcnow() - self.checktime
         current_minute = round(since_checktime.total_seconds() / 60)
         current_minute = current_minute % 1440
-        multiplier = 0
-        for i in range(current_minute, current_minute + interval):
-            multiplier += 1.003**i
-        multiplier = multiplier / 24568
+        return perch_multiplier(current_minute, interval)
+
+    def collect_credits(self, serverid, multiplier):
+        """Calculate how many credits Parrot will collect during the perch.
+        Return whether any feeder was credited. The caller marks the server
+        as changed."""
+        parrot = self.save_file["Servers"][serverid]["Parrot"]
+        feeders = self.save_file["Servers"][serverid]["Feeders"]
 
+        credited = False
         for feederid in feeders:
             pellets = feeders[feederid]["PelletsFed"]
             if pellets > 50: # Feeding more than 50 pellets (average healthy appetite) is ignored
@@ -736,8 +1025,18 @@ class Parrot:
             # the day if they fed right after checktime
 
             feeders[feederid]["CreditsCollected"] += 1.5 * parrot["Cost"] * pellets * multiplier
+            credited = credited or pellets > 0
+        return credited
+
+    def load_files(self):
+        """Read the save file, updating it if necessary."""
+        self.save_file = dataIO.load_json(SAVE_FILEPATH)
+        self.update_version()
 
-        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+    def start_tasks(self):
+        """Start the loop and the task that writes the save file."""
+        self.loop_task = self.bot.loop.create_task(self.loop()) # remember to change __unload()
+        self.save_task = self.bot.loop.create_task(self.save_loop())
 
     def update_version(self):
         """Update the save file if necessary."""
@@ -782,7 +1081,39 @@ class Parrot:
             self.save_file["Global"]["PerchInterval"] = 20
             self.save_file["Global"]["Version"] = "2.3"
 
-        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+        store = ServerStore(SERVERS_DIRPATH)
+        if self.save_file["Global"]["Version"] == "2.3":
+            # Move each server's data out of parrot.json into its own file
+            for serverid, server_data in self.save_file["Servers"].items():
+                store[serverid] = server_data
+            self.save_file["Global"]["Version"] = "3"
+        self.save_file["Servers"] = store
+
+        if self.save_file["Global"]["Version"] == "3":
+            # Parrot's age is worked out from when he was born instead of counted hourly.
+            # Servers written by an interrupted run are already converted.
+            now = time.time()
+            for serverid in store:
+                parrot = store[serverid]["Parrot"]
+                if "HoursAlive" in parrot:
+                    parrot["Born"] = now - parrot.pop("HoursAlive") * 3600
+            store.mark()
+            self.save_file["Global"]["Version"] = "3.1"
+
+        if self.save_file["Global"]["Version"] == "3.1":
+            # Warnings are reset by starting a new round instead of by
+            # changing every server
+            for serverid in store:
+                parrot = store[serverid]["Parrot"]
+                parrot["WarnedRound"] = 0 if parrot.pop("WarnedYet", False) else -1
+            store.mark()
+            self.save_file["Global"]["WarningRound"] = 0
+            self.save_file["Global"]["ChunkSize"] = 500
+            self.save_file["Global"]["Version"] = "3.2"
+
+        self.mark_dirty()
+        self.save() # servers are written before parrot.json, so an
+                    # interrupted move is redone on the next load
 
     def parrot_perched_on(self, server):
         """Return the user ID of whoever Parrot is perched on.
@@ -799,11 +1130,68 @@ class Parrot:
         self.add_server(server) # make sure the server is in the data file
         if availability is False:
             self.save_file["Servers"][server.id]["Feeders"][user.id]["HeistBoostAvailable"] = False
-            dataIO.save_json(SAVE_FILEPATH, self.save_file)
+            self.mark_dirty(server.id)
         return self.save_file["Servers"][server.id]["Feeders"][user.id]["HeistBoostAvailable"]
 
+    def mark_dirty(self, serverid=None):
+        """Mark a server's data as changed, so that it is written soon. With
+        no server ID, mark the global settings."""
+        if serverid is None:
+            self.dirty = True
+        else:
+            self.save_file["Servers"].mark(serverid)
+
+    def save(self):
+        """Write the global settings and the servers that have changed
+        since the last write."""
+        start = time.perf_counter()
+        written = self.save_file["Servers"].save()
+        self.finish_save(written, time.perf_counter() - start)
+
+    async def save_in_chunks(self):
+        """Write the save file like self.save(), but pause after every
+        SAVE_CHUNK_SIZE server files, so that writing many servers doesn't
+        block the bot. A server that changes while paused is written next time."""
+        store = self.save_file["Servers"]
+        written = []
+        seconds = 0
+        for index, serverid in enumerate(store.pending()):
+            await self.pause(index, SAVE_CHUNK_SIZE) # a file takes longer than a server
+            start = time.perf_counter()
+            filepath = store.save_server(serverid)
+            seconds += time.perf_counter() - start
+            if filepath is not None:
+                written.append(filepath)
+        self.finish_save(written, seconds)
+
+    def finish_save(self, written, seconds):
+        """Write the global settings if they have changed, after the server
+        files in written, which took seconds to write. Count the writes."""
+        start = time.perf_counter()
+        if self.dirty:
+            written.append(self.save_global())
+            self.dirty = False
+        if written:
+            self.save_seconds += seconds + time.perf_counter() - start
+            self.saves += len(written)
+            self.bytes_saved += sum(os.path.getsize(filepath) for filepath in written)
+
+    def save_global(self):
+        """Write the global settings to parrot.json and return its path."""
+        dataIO.save_json(SAVE_FILEPATH, {"Global": self.save_file["Global"]})
+        return SAVE_FILEPATH
+
+    async def save_loop(self):
+        """Write the save file at most once every SAVE_INTERVAL seconds,
+        however many times it changes in between."""
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            await self.save_in_chunks()
+
     def __unload(self):
         self.loop_task.cancel()
+        self.save_task.cancel()
+        self.save()
 
 def dir_check():
     """Create a folder and save file for the cog if they don't exist."""
@@ -811,6 +1199,10 @@ def dir_check():
         print("Creating data/KeaneCogs/parrot folder...")
         os.makedirs("data/KeaneCogs/parrot")
 
+    if not os.path.exists(SERVERS_DIRPATH):
+        print("Creating {} folder...".format(SERVERS_DIRPATH))
+        os.makedirs(SERVERS_DIRPATH)
+
     if not dataIO.is_valid_json(SAVE_FILEPATH):
         print("Creating default parrot.json...")
         dataIO.save_json(SAVE_FILEPATH, SAVE_DEFAULT)
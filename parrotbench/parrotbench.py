@@ -0,0 +1,183 @@
+"""Owner commands that benchmark the parrot cog."""
+import os
+import random
+import asyncio
+import copy
+import datetime
+import shutil
+import tempfile
+import time
+import types
+
+from discord.ext import commands
+from .utils import checks
+from .utils.dataIO import dataIO
+from .parrot import (Parrot, ServerStore, perch_multiplier, SAVE_DEFAULT, SERVER_DEFAULT,
+                     FEEDER_DEFAULT, CREDIT_GROWTH, CREDIT_DAY_TOTAL)
+
+def fake_bot(loop):
+    """Build a stand-in for the bot where every server has one member,
+    messages aren't really sent and deposits go nowhere."""
+    async def request(*args):
+        await asyncio.sleep(0) # a real request would let other tasks run
+    member = types.SimpleNamespace(display_name="Feeder")
+    bank = types.SimpleNamespace(deposit_credits=lambda user, amount: None)
+    return types.SimpleNamespace(loop=loop,
+                                 get_server=lambda serverid: types.SimpleNamespace(
+                                     id=serverid, get_member=lambda userid: member),
+                                 get_cog=lambda name: types.SimpleNamespace(bank=bank),
+                                 send_message=request,
+                                 leave_server=request)
+
+class SimulatedParrot(Parrot):
+    """A Parrot for benchmarks. Its files go in a temporary folder, which
+    cleanup() deletes, and it starts no background tasks."""
+
+    def load_files(self):
+        self.dirpath = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dirpath, "servers"))
+        self.save_file = {"Servers": ServerStore(os.path.join(self.dirpath, "servers")),
+                          "Global": copy.deepcopy(SAVE_DEFAULT["Global"])}
+
+    def start_tasks(self):
+        pass
+
+    def save_global(self):
+        filepath = os.path.join(self.dirpath, "parrot.json")
+        dataIO.save_json(filepath, {"Global": self.save_file["Global"]})
+        return filepath
+
+    def add_servers(self, servers, feeders):
+        """Add made-up servers with feeders, as if they had been saved."""
+        for serverid in range(servers):
+            server_data = copy.deepcopy(SERVER_DEFAULT)
+            parrot = server_data["Parrot"]
+            parrot["Appetite"] = 50
+            parrot["Fullness"] = random.randint(0, 50)
+            parrot["ChecksAlive"] = random.randint(0, 5)
+            parrot["StarvedLoops"] = random.randint(0, 2)
+            for feederid in range(feeders):
+                feeder = copy.deepcopy(FEEDER_DEFAULT)
+                feeder["PelletsFed"] = random.randint(0, 25)
+                feeder["CreditsCollected"] = random.uniform(0, 500)
+                server_data["Feeders"][str(feederid)] = feeder
+            self.save_file["Servers"][str(serverid)] = server_data
+        self.save_file["Servers"].changed.clear()
+
+    def cleanup(self):
+        shutil.rmtree(self.dirpath)
+
+class ParrotBench:
+    """Benchmarks for the parrot cog. They run on their own Parrot objects,
+    so the parrot cog needs to be installed but not loaded, and its
+    servers and data are left alone."""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def parrotbench(self, ctx, name: str = "credits"):
+        """Run a benchmark of the parrot cog and show the results.
+
+        credits: how long a perch takes to credit feeders on 10000 servers
+        stall: the longest the bot is blocked by a daily check and the save
+        after it on 50000 servers"""
+        if name == "credits":
+            report = self.benchmark_credits()
+        elif name == "stall":
+            await self.bot.say("Running the stall benchmark...")
+            report = await self.benchmark_stall()
+        else:
+            return await self.bot.say("Unknown benchmark.")
+        return await self.bot.say("```\n{}```".format(report))
+
+    def setting(self, name):
+        """Return a global setting of the loaded parrot cog, or its default
+        if the cog isn't loaded."""
+        parrot = self.bot.get_cog("Parrot")
+        if parrot is None:
+            return SAVE_DEFAULT["Global"][name]
+        return parrot.save_file["Global"][name]
+
+    def benchmark_credits(self, servers=10000, feeders=5):
+        """Time crediting one perch on many servers, comparing the old
+        per-server loop over every minute of the perch with the multiplier
+        worked out once. Return a report."""
+        interval = self.setting("PerchInterval")
+        minute = random.randrange(1440)
+        simulation = SimulatedParrot(fake_bot(self.bot.loop))
+        try:
+            simulation.add_servers(servers, feeders)
+            serverids = list(simulation.save_file["Servers"])
+
+            start = time.perf_counter()
+            for serverid in serverids:
+                multiplier = 0
+                for i in range(minute, minute + interval):
+                    multiplier += CREDIT_GROWTH**i
+                simulation.collect_credits(serverid, multiplier / CREDIT_DAY_TOTAL)
+            summed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            multiplier = perch_multiplier(minute, interval)
+            for serverid in serverids:
+                simulation.collect_credits(serverid, multiplier)
+            closed_form = time.perf_counter() - start
+        finally:
+            simulation.cleanup()
+
+        return ("{} servers with {} feeders, {} minute perch\n"
+                "Summed per server: {:.1f} ms\n"
+                "Closed form once: {:.1f} ms\n"
+                .format(servers, feeders, interval, summed * 1000, closed_form * 1000))
+
+    async def benchmark_stall(self, servers=50000, feeders=2):
+        """Time the longest that the event loop is blocked by a perch at
+        checktime on many servers and the save after it, with the current
+        ChunkSize and with every server in one chunk. Return a report."""
+        chunk_size = self.setting("ChunkSize")
+        report = ("{} servers with {} feeders, perch at checktime and save\n"
+                  .format(servers, feeders))
+        for size in (chunk_size, servers):
+            stall, seconds, written = await self.simulate_check(servers, feeders, size)
+            report += ("ChunkSize {}: longest stall {:.1f} ms, {:.2f} s in total, "
+                       "{} files written\n".format(size, stall * 1000, seconds, written))
+        return report
+
+    async def simulate_check(self, servers, feeders, chunk_size):
+        """Run a perch at checktime and the save after it on a SimulatedParrot
+        with made-up servers. Return the longest time the event loop went
+        without running other tasks, the total time and the number of files
+        written."""
+        simulation = SimulatedParrot(fake_bot(self.bot.loop))
+        simulation.save_file["Global"]["ChunkSize"] = chunk_size
+        simulation.add_servers(servers, feeders)
+        simulation.checktime = datetime.datetime.utcnow()
+
+        longest = 0
+        async def monitor():
+            nonlocal longest
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0)
+                now = time.perf_counter()
+                longest = max(longest, now - last)
+                last = now
+
+        monitor_task = self.bot.loop.create_task(monitor())
+        await asyncio.sleep(0) # let the monitor start
+        start = time.perf_counter()
+        try:
+            await simulation.perch()
+            await simulation.save_in_chunks()
+            seconds = time.perf_counter() - start
+            await asyncio.sleep(0) # let the monitor see the last stall
+        finally:
+            monitor_task.cancel()
+            simulation.cleanup()
+        return longest, seconds, simulation.saves
+
+def setup(bot):
+    """Create a ParrotBench object."""
+    bot.add_cog(ParrotBench(bot))
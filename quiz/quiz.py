@@ -1,11 +1,23 @@
 """A trivia cog that uses Open Trivia Database."""
 import os
 import html
+import json
+import inspect
 import asyncio
+import base64
+import collections
+import copy
+import functools
+import hashlib
+import heapq
 import time
 import datetime
 import random
 import math
+import string
+import sys
+import traceback
+import unicodedata
 
 import aiohttp
 import discord
@@ -15,28 +27,440 @@ from .utils import checks
 from .utils.dataIO import dataIO
 
 SAVE_FILEPATH = "data/KeaneCogs/quiz/quiz.json"
+BANK_FILEPATH = "data/KeaneCogs/quiz/bank.json"
+CATEGORIES_FILEPATH = "data/KeaneCogs/quiz/categories.json"
+STATS_FILEPATH = "data/KeaneCogs/quiz/stats.log" # one JSON line per game, never rewritten
+
+SAVE_DEFAULT = {
+    "Servers": {},
+    "Global": {
+        "Countdown": "edit", # how questions show their remaining time
+        "Version": "4"
+    }
+}
+
+SERVER_DEFAULT = {
+    "Seen": { # Bloom filters over the text of questions the server has been asked
+        "Current": "", # base64 bits; "" when empty
+        "Previous": "",
+        "Count": 0 # questions added to Current
+    },
+    "Stats": { # running totals of [answers, correct answers, seconds taken]
+        "Difficulties": {},
+        "Categories": {}, # category IDs as keys
+        "Players": {} # player IDs as keys
+    }
+}
+
+CATEGORIES = range(9, 33) # OTDB category IDs
+DIFFICULTIES = ("easy", "medium", "hard")
+
+BANK_POOL_SIZE = 500 # most questions kept in the bank per category and difficulty
+                     # (more than OTDB has for most, so the bank mirrors OTDB)
+BANK_REFILL_INTERVAL = 300 # seconds between checks of the bank's pools
+CATEGORY_TTL = 86400 # seconds before the category cache is refreshed
+
+API_URL = "https://opentdb.com/"
+API_TIMEOUT = 10 # seconds before an OTDB request is abandoned
+API_INTERVAL = 5 # seconds between OTDB requests; OTDB allows one per 5 seconds per IP
+API_RETRIES = 4 # attempts per OTDB request
+API_BACKOFF = 2 # seconds; the base of the exponential backoff between attempts
+
+COUNTDOWN_MODES = ("edit", "reactions", "off")
+COUNTDOWN_EDIT_INTERVAL = 5 # seconds between countdown edits in "edit" mode
+BUDGET_RATE = 10 # Discord requests per second shared by all quiz games
+BUDGET_BURST = 20 # requests that can be made at once after the budget has been idle
+
+PREFETCH_AHEAD = 3 # questions before the end of a game that the next game's batch is loaded
+PREFETCH_TTL = 600 # seconds a prefetched batch is kept for the channel's next game
+
+MAX_SCORE = 20 * 1250 # every answer first and instant in a 20 question game
+
+SEEN_CAPACITY = 1000 # questions per generation of a server's seen filter
+SEEN_BITS = 9600 # bits per generation, for about a 1% false positive rate at capacity
+SEEN_HASHES = 7 # bits set per question
+
+STATS_TARGET = 0.6 # correct answer rate that difficulty selection aims for
+STATS_PRIORS = {"easy": 0.8, "medium": 0.6, "hard": 0.4} # assumed rates with no answers
+STATS_PRIOR_WEIGHT = 20 # answers that the assumed rates count as
+STATS_EXPLORE = 0.2 # chance of a random difficulty, so that every rate keeps being measured
+
+ANSWER_SLACK = 10 # characters a typed answer can have beyond the longest normalized choice
+ASCII_PUNCTUATION = str.maketrans("", "", string.punctuation) # for str.translate
+
+class QuestionBank:
+    """A local store of OTDB questions, grouped by category and difficulty.
+
+    The bank file looks like {"Pools": {"<category id>": {"<difficulty>": [...]}}},
+    where each list holds question dicts exactly as OTDB's api.php returns them.
+    A bank file can be filled by hand to run the cog without reaching OTDB.
+    If filepath is None, the bank is only kept in memory."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        if filepath is None:
+            self.data = {"Pools": {}}
+        else:
+            self.data = dataIO.load_json(filepath)
+        self.dirty = False
+
+    def pool(self, category, difficulty):
+        """Returns the list of questions for a category and difficulty."""
+        pools = self.data["Pools"].setdefault(str(category), {})
+        return pools.setdefault(difficulty, [])
+
+    def count(self, category, difficulty=None):
+        """Counts the questions available for a category, optionally
+        only those of one difficulty."""
+        pools = self.data["Pools"].get(str(category), {})
+        if difficulty:
+            return len(pools.get(difficulty, []))
+        return sum(len(pool) for pool in pools.values())
+
+    def categories(self, amount, difficulty=None):
+        """Lists the categories that have at least amount questions."""
+        return [int(category) for category in self.data["Pools"]
+                if self.count(category, difficulty) >= amount]
+
+    def add(self, category, difficulty, questions):
+        """Adds questions to a pool, skipping ones it already has.
+        Returns the number of questions added."""
+        pool = self.pool(category, difficulty)
+        known = {question["question"] for question in pool}
+        added = 0
+        for question in questions:
+            if question["question"] not in known:
+                known.add(question["question"])
+                pool.append(question)
+                added += 1
+        if added:
+            self.dirty = True
+        return added
+
+    def draw(self, category, amount, difficulty=None, seen=(), repeats=False):
+        """Returns amount random questions from a category that aren't in seen,
+        or returns None if the category doesn't have enough of them. If repeats
+        is True, questions in seen make up the amount instead, and None is only
+        returned if the category doesn't have amount questions at all."""
+        if difficulty:
+            difficulties = [difficulty]
+        else:
+            difficulties = list(self.data["Pools"].get(str(category), {}))
+
+        unseen = []
+        repeated = []
+        for diff in difficulties:
+            for question in self.pool(category, diff):
+                if question["question"] in seen:
+                    repeated.append(question)
+                else:
+                    unseen.append(question)
+        if len(unseen) >= amount:
+            return random.sample(unseen, amount)
+        if not repeats or len(unseen) + len(repeated) < amount:
+            return None
+        questions = unseen + random.sample(repeated, amount - len(unseen))
+        random.shuffle(questions)
+        return questions
+
+    def save(self):
+        """Writes the bank to its file if it has changed."""
+        if self.dirty and self.filepath is not None:
+            dataIO.save_json(self.filepath, self.data)
+            self.dirty = False
+
+def credit_curve(score):
+    """Calculates credits earned from a score."""
+    # non-linear credit earning .0002x^{2.9} where x is score/100
+    adjusted = score / 100
+    if adjusted < 156.591:
+        result = .0002 * (adjusted**2.9)
+    else:
+        result = (.6625 * math.exp(.0411 * adjusted)) + 50
+
+    return round(result)
+
+CREDIT_TABLE = [credit_curve(score) for score in range(MAX_SCORE + 1)]
+
+@functools.lru_cache(maxsize=8192)
+def seen_positions(text):
+    """Returns the bits a question's text sets in a seen filter."""
+    digest = hashlib.sha1(text.encode()).digest()
+    first = int.from_bytes(digest[:8], "little")
+    step = int.from_bytes(digest[8:16], "little") | 1
+    return tuple((first + i * step) % SEEN_BITS for i in range(SEEN_HASHES))
+
+class SeenFilter:
+    """The questions a server has been asked, as two generations of Bloom
+    filter over question text. When the current generation is full it
+    replaces the previous one, so the filter's size is fixed and the
+    oldest questions eventually become available again."""
+
+    def __init__(self, data):
+        self.data = data # the server's "Seen" dict in the save file
+        self.generations = [self.decode(data["Current"]), self.decode(data["Previous"])]
+
+    @staticmethod
+    def decode(bits):
+        if not bits:
+            return bytearray(SEEN_BITS // 8)
+        return bytearray(base64.b64decode(bits))
+
+    @staticmethod
+    def encode(bits):
+        if not any(bits):
+            return ""
+        return base64.b64encode(bytes(bits)).decode()
+
+    def __contains__(self, text):
+        positions = seen_positions(text)
+        return any(all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
+                   for bits in self.generations)
+
+    def add(self, texts):
+        """Records questions as seen and updates the save file's copy."""
+        for text in texts:
+            if self.data["Count"] >= SEEN_CAPACITY:
+                self.generations = [bytearray(SEEN_BITS // 8), self.generations[0]]
+                self.data["Count"] = 0
+            bits = self.generations[0]
+            for pos in seen_positions(text):
+                bits[pos >> 3] |= 1 << (pos & 7)
+            self.data["Count"] += 1
+
+        self.data["Current"] = self.encode(self.generations[0])
+        self.data["Previous"] = self.encode(self.generations[1])
+
+def add_stats(totals, correct, seconds):
+    """Adds one answer to a list of [answers, correct answers, seconds taken]."""
+    totals[0] += 1
+    totals[1] += correct
+    totals[2] += seconds
+
+def accuracy(totals, prior):
+    """Returns the correct answer rate of a list of totals, which may be None.
+    The rate starts at prior and moves away from it as answers are added."""
+    answers, correct = totals[:2] if totals else (0, 0)
+    return (correct + prior * STATS_PRIOR_WEIGHT) / (answers + STATS_PRIOR_WEIGHT)
+
+class RequestBudget:
+    """A token bucket that limits how many Discord requests all quiz games
+    make together. Waiting requests are served in order, so concurrent
+    games slow down evenly instead of running into Discord's rate limits."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        """Adds the tokens earned since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Takes a token if one is free right now. Used for requests that
+        can be skipped, like countdown updates."""
+        if self.lock.locked(): # don't cut in front of waiting requests
+            return False
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Waits until a token is free and takes it."""
+        async with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+class Scoreboard:
+    """The players of one game, their scores and their display names.
+
+    Scores are updated in place as points are awarded. The top players are
+    picked out without sorting everyone, and every player is only put in
+    order for the final ranking or to look up ranks. Ties are ranked by who
+    joined first."""
+
+    def __init__(self):
+        self.scores = collections.OrderedDict() # player IDs as keys, in join order
+        self.names = {} # player IDs as keys and display names as values
+        self.ranks = {} # player IDs as keys and ranks as values, built when needed
+
+    def __contains__(self, playerid):
+        return playerid in self.scores
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, playerid, name):
+        """Adds a player with no points."""
+        self.scores[playerid] = 0
+        self.names[playerid] = name
+        self.ranks.clear()
+
+    def award(self, playerid, points):
+        """Adds points to a player's score."""
+        self.scores[playerid] += points
+        self.ranks.clear()
+
+    def score(self, playerid):
+        """Returns a player's score."""
+        return self.scores[playerid]
+
+    def ranking(self):
+        """Returns a list of every player ID in rank order."""
+        # sorting is stable, so players who joined first stay ahead on ties
+        return sorted(self.scores, key=self.scores.__getitem__, reverse=True)
+
+    def top(self, amount=None):
+        """Returns a list of (player ID, score) for the highest ranked players,
+        or for every player in rank order if amount is None."""
+        if amount is None:
+            ranking = self.ranking()
+        else:
+            ranking = heapq.nlargest(amount, self.scores, key=self.scores.__getitem__)
+        return [(playerid, self.scores[playerid]) for playerid in ranking]
+
+    def rank(self, playerid):
+        """Returns a player's rank, starting from 1."""
+        if not self.ranks:
+            self.ranks.update((playerid, rank) for rank, playerid
+                              in enumerate(self.ranking(), 1))
+        return self.ranks[playerid]
+
+def weighted_choice(population, weights):
+    """Returns one random item from population, chosen with the given weights."""
+    try:
+        return random.choices(population, weights)[0]
+    except AttributeError:
+        # random.choices is new in Python 3.6
+        rand = random.uniform(0, sum(weights))
+        total = 0
+        for item, weight in zip(population, weights):
+            total += weight
+            if total >= rand:
+                return item
+        return population[-1]
+
+Question = collections.namedtuple("Question", ["text", # decoded question text
+                                             "choices", # four decoded choices, in display order
+                                             "correct", # index of the correct choice
+                                             "category", # decoded category name
+                                             "body", # the question's message, ready to send
+                                             "lookup", # normalized answers as keys, letters as values
+                                             "longest"]) # longest message that could be an answer
+
+def normalize_answer(text):
+    """Reduces an answer to the form used in Question.lookup: casefolded,
+    without accents or punctuation, and with single spaces between words."""
+    text = text.casefold()
+    try:
+        text.encode("ascii")
+    except UnicodeEncodeError:
+        text = "".join(char for char in unicodedata.normalize("NFKD", text)
+                       if not unicodedata.combining(char)
+                       and not unicodedata.category(char).startswith("P"))
+    return " ".join(text.translate(ASCII_PUNCTUATION).split())
+
+def make_question(raw, number, total):
+    """Converts a question dict from OTDB into a Question. number is the
+    question's position in the game and total is the game's length."""
+    correct = html.unescape(raw["correct_answer"])
+    if len(raw["incorrect_answers"]) == 1: # true/false question
+        choices = ("True", "False", "", "")
+    else:
+        choices = [correct] + [html.unescape(answer) for answer in raw["incorrect_answers"]]
+        random.shuffle(choices)
+        choices = tuple(choices)
+    text = html.unescape(raw["question"])
+
+    body = "```\n"
+    body += "{} ({}/{})\n".format(text, number, total)
+    body += "A. {}\n".format(choices[0])
+    body += "B. {}\n".format(choices[1])
+    body += "C. {}\n".format(choices[2])
+    body += "D. {}\n".format(choices[3])
+    body += "```"
+
+    # Players can type a letter or the text of a choice
+    lookup = {}
+    for letter, choice in zip("abcd", choices):
+        if normalize_answer(choice):
+            lookup.setdefault(normalize_answer(choice), letter)
+    for letter in "abcd":
+        lookup[letter] = letter # a choice like "A" can't hide a letter
+    longest = max(len(key) for key in lookup) + ANSWER_SLACK
+
+    return Question(text, choices, choices.index(correct), html.unescape(raw["category"]), body,
+                    lookup, longest)
+
+def deep_sizeof(obj, seen=None):
+    """Estimates the memory used by an object and everything it contains."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    return size
 
 class Quiz:
     """Play a kahoot-like trivia game with questions from Open Trivia Database."""
 
     def __init__(self, bot):
         self.bot = bot
-        self.save_file = dataIO.load_json(SAVE_FILEPATH)
+        self.load_files()
 
         self.playing_channels = {}
-        self.timeout = 20
-        self.game_tasks = []
+        self.timeout = 20 # seconds that lobbies stay open
+        self.questions_per_game = 20
+        self.question_time = 10 # seconds players have to answer each question
+        self.intro_time = 4 # seconds between the introduction and the first question
+        self.results_time = 4 # seconds between the scoreboard and the next question
+        self.games = {} # channel IDs as keys and (game task, start time) as values
+        self.game_history = collections.deque(maxlen=100) # (duration, outcome) of past games
+        self.message_tasks = set()
+        self.prefetches = {} # channel IDs as keys and (load task, expiry timer) as values
+        self.start_times = collections.deque(maxlen=100) # (seconds until questions were ready,
+                                                         #  seconds until the first question,
+                                                         #  whether the batch was prefetched)
+        self.lobby_timers = {} # channel IDs as keys and timer handles as values
+        self.answer_channels = set() # IDs of channels with a question open for answers
+        self.dispatch_lag = collections.deque(maxlen=1000) # seconds between an answer's
+                                                           # creation and on_message
 
-        self.starter_task = bot.loop.create_task(self.start_loop())
+        self.seen = {} # server IDs as keys and SeenFilters as values, loaded when needed
+        self.save_changed = False # whether seen filters or stats need to be saved
+        self.budget = RequestBudget(BUDGET_RATE, BUDGET_BURST)
+        self.api_lock = asyncio.Lock() # held while an OTDB request is waiting its turn or in flight
+        self.api_last = 0 # time.monotonic() when the last OTDB request finished
+        self.start_tasks()
 
     @commands.group(pass_context=True, no_pm=True)
     async def quiz(self, ctx):
         """Play a kahoot-like trivia game with questions from Open Trivia Database.
 
         In this game, you will compete with other players to correctly answer each
-        question as quickly as you can. You have 10 seconds to type the answer
-        choice before time runs out. Only your first answer will be registered.
-        The longer you take to say the right answer, the fewer points you get.
+        question as quickly as you can. You have 10 seconds to type the letter
+        or the text of the answer choice before time runs out. Only your first
+        answer will be registered. The longer you take to say the right answer,
+        the fewer points you get.
         If you get it wrong, you get no points.
         """
         if ctx.invoked_subcommand is None:
@@ -48,11 +472,7 @@ class Quiz:
         channel = ctx.message.channel
         player = ctx.message.author
         if channel.id not in self.playing_channels:
-            self.playing_channels[channel.id] = {"Start":datetime.datetime.utcnow(),
-                                                 "Started":False,
-                                                 "Players":{player.id:0},
-                                                 "Answers":{}
-                                                }
+            self.open_lobby(channel, player)
             return await self.bot.say("{} is starting a quiz game! It will start "
                                       "in 20 seconds. Use `{}quiz play` to join."
                                       .format(player.display_name, ctx.prefix))
@@ -63,231 +483,492 @@ class Quiz:
         elif channelinfo["Started"]:
             await self.bot.say("A quiz game is already underway.")
         else:
-            channelinfo["Players"][player.id] = 0
+            channelinfo["Players"].add(player.id, player.display_name)
             await self.bot.say("{} joined the game.".format(player.display_name))
 
-    async def start_loop(self):
-        """Starts quiz games when the timeout period ends."""
-        while True:
-            await asyncio.sleep(1)
-            for channelid in list(self.playing_channels):
-                channelinfo = self.playing_channels[channelid]
-                since_start = (datetime.datetime.utcnow() - channelinfo["Start"]).total_seconds()
-                if since_start > self.timeout and not channelinfo["Started"]:
-                    if len(channelinfo["Players"]) > 1:
-                        channel = self.bot.get_channel(channelid)
-                        self.game_tasks.append(self.bot.loop.create_task(self.game(channel)))
-                        channelinfo["Started"] = True
-                    else:
-                        await self.bot.send_message(self.bot.get_channel(channelid),
-                                                    "Nobody else joined the quiz game.")
-                        self.playing_channels.pop(channelid)
+    @quiz.command(name="tournament", pass_context=True)
+    @checks.admin_or_permissions(manage_server=True)
+    async def quiz_tournament(self, ctx, *channels: discord.Channel):
+        """Start a quiz tournament in this channel and other channels.
+
+        Every channel gets the same questions at the same time, and players
+        from all of them are ranked on one scoreboard. Players join by using
+        the play command in any of the channels."""
+        host = ctx.message.channel
+        player = ctx.message.author
+        others = []
+        for channel in channels:
+            if channel.id != host.id and channel not in others:
+                others.append(channel)
+        if not others:
+            return await self.bot.say("Mention at least one other channel "
+                                      "to hold a tournament in.")
+
+        for channel in [host] + others:
+            if channel.server.id != host.server.id:
+                return await self.bot.say("Tournament channels must be on this server.")
+            if channel.id in self.playing_channels:
+                return await self.bot.say("A quiz game is already underway in {}."
+                                          .format(channel.mention))
+            if (channel.type != discord.ChannelType.text
+                    or not channel.permissions_for(channel.server.me).send_messages):
+                return await self.bot.say("I can't send messages in {}."
+                                          .format(channel.mention))
+
+        self.open_lobby(host, player, others)
+        await self.broadcast([host] + others,
+                             "{} is starting a quiz tournament in {}! It will start "
+                             "in 20 seconds. Use `{}quiz play` to join."
+                             .format(player.display_name,
+                                     ", ".join(channel.mention for channel in [host] + others),
+                                     ctx.prefix))
+
+    @quiz.command(name="stats", pass_context=True)
+    async def quiz_stats(self, ctx, player: discord.Member = None):
+        """Show how well this server, or a player, answers quiz questions."""
+        server = ctx.message.server
+        if server.id not in self.save_file["Servers"]:
+            return await self.bot.say("No quiz games have been played on this server yet.")
+        stats = self.save_file["Servers"][server.id]["Stats"]
+
+        if player is not None:
+            totals = stats["Players"].get(player.id)
+            if totals is None:
+                return await self.bot.say("{} hasn't answered any quiz questions yet."
+                                          .format(player.display_name))
+            return await self.bot.say("{} has answered {} questions, {:.0%} of them "
+                                      "correctly, in {:.1f} seconds on average."
+                                      .format(player.display_name, totals[0],
+                                              totals[1] / totals[0], totals[2] / totals[0]))
+
+        message = "```\n"
+        for difficulty in DIFFICULTIES:
+            totals = stats["Difficulties"].get(difficulty, [0, 0, 0])
+            if totals[0]:
+                message += "{:<7}{:>6} answers, {:>4.0%} correct, {:.1f} s\n".format(
+                    difficulty, totals[0], totals[1] / totals[0], totals[2] / totals[0])
+            else:
+                message += "{:<7}{:>6} answers\n".format(difficulty, 0)
+        message += "```"
+        return await self.bot.say(message)
+
+    @quiz.command(name="countdown", pass_context=True)
+    @checks.is_owner()
+    async def quiz_countdown(self, ctx, mode: str = None):
+        """View or change how questions show their remaining time.
+
+        edit: the question is edited every few seconds to show the time left
+        reactions: a number reaction is added every second (uses many requests)
+        off: no countdown is shown"""
+        if mode is None:
+            return await self.bot.say("Current setting: {}"
+                                      .format(self.save_file["Global"]["Countdown"]))
+
+        mode = mode.lower()
+        if mode not in COUNTDOWN_MODES:
+            return await self.bot.say("The countdown mode must be one of: {}."
+                                      .format(", ".join(COUNTDOWN_MODES)))
+
+        self.save_file["Global"]["Countdown"] = mode
+        self.save()
+        return await self.bot.say("Setting change successful.")
+
+    @quiz.command(name="diagnostics", pass_context=True)
+    @checks.is_owner()
+    async def quiz_diagnostics(self, ctx):
+        """Show how the quiz cog is performing."""
+        report = ""
+        if self.dispatch_lag:
+            lags = sorted(self.dispatch_lag)
+            report += ("Answer dispatch lag over the last {} answers:\n"
+                       "mean {:.3f} s, 95th percentile {:.3f} s, max {:.3f} s\n"
+                       .format(len(lags), sum(lags) / len(lags),
+                               lags[int(len(lags) * 0.95)], lags[-1]))
+        else:
+            report += "No answers have been recorded yet.\n"
+
+        if self.game_history:
+            outcomes = collections.Counter(outcome for _, outcome in self.game_history)
+            durations = [duration for duration, _ in self.game_history]
+            report += ("\nLast {} games: {} finished, {} failed, {} cancelled, "
+                       "mean duration {:.0f} s\n"
+                       .format(len(self.game_history), outcomes["finished"],
+                               outcomes["failed"], outcomes["cancelled"],
+                               sum(durations) / len(durations)))
+
+        if self.start_times:
+            ready = [times[0] for times in self.start_times]
+            first = [times[1] for times in self.start_times]
+            prefetched = sum(1 for times in self.start_times if times[2])
+            report += ("\nLast {} game starts: questions ready after {:.2f} s (max {:.2f} s), "
+                       "first question after {:.2f} s (max {:.2f} s), {} prefetched\n"
+                       .format(len(self.start_times), sum(ready) / len(ready), max(ready),
+                               sum(first) / len(first), max(first), prefetched))
+
+        report += "\n{} lobbies, {} games running\n".format(
+            len(self.lobby_timers), len(self.games))
+        now = time.monotonic()
+        for channelid, (_, started) in list(self.games.items())[:20]:
+            channelinfo = self.playing_channels.get(channelid, {})
+            report += "{}: {}, {} players, {:.0f} s, {:.1f} KB\n".format(
+                channelid, channelinfo.get("Phase", "ending"),
+                len(channelinfo.get("Players", ())), now - started,
+                deep_sizeof(channelinfo) / 1024)
+        if len(self.games) > 20:
+            report += "...and {} more\n".format(len(self.games) - 20)
+        return await self.bot.say("```\n{}```".format(report))
+
+    def open_lobby(self, channel, player, others=()):
+        """Creates a quiz game lobby on a channel with the player in it.
+        For a tournament, others are the other channels that play the game.
+        They share the lobby, and the game is run from channel."""
+        channelinfo = {"Started":False,
+                       "Phase":"lobby",
+                       "Channels":[channel] + list(others),
+                       "Players":Scoreboard(), # every channel's players together
+                       "Answers":{},
+                       "Window":None # set while a question is open
+                      }
+        channelinfo["Players"].add(player.id, player.display_name)
+        for game_channel in channelinfo["Channels"]:
+            self.playing_channels[game_channel.id] = channelinfo
+        self.lobby_timers[channel.id] = self.bot.loop.call_later(
+            self.timeout, self.close_lobby, channel.id)
+        self.prefetch(channel) # load the questions while the lobby fills
+
+    def remove_game(self, channelid, channelinfo=None):
+        """Removes a game from every channel it is played on. If channelinfo
+        is given, only channels still holding that game's state are cleared,
+        so that a lobby opened since the game ended is kept."""
+        if channelinfo is None:
+            channelinfo = self.playing_channels.get(channelid)
+            if channelinfo is None:
+                return
+        for channel in channelinfo["Channels"]:
+            if self.playing_channels.get(channel.id) is channelinfo:
+                del self.playing_channels[channel.id]
+                self.answer_channels.discard(channel.id)
+
+    def close_lobby(self, channelid):
+        """Starts the channel's quiz game when its lobby's timeout period ends."""
+        self.lobby_timers.pop(channelid)
+        channelinfo = self.playing_channels[channelid]
+        channel = self.bot.get_channel(channelid)
+        if len(channelinfo["Players"]) > 1:
+            task = self.bot.loop.create_task(self.game(channel))
+            self.games[channelid] = (task, time.monotonic())
+            task.add_done_callback(lambda task: self.game_done(channelid, channelinfo, task))
+            channelinfo["Started"] = True
+            channelinfo["Closed"] = time.monotonic()
+        else:
+            self.remove_game(channelid)
+            task = self.bot.loop.create_task(self.broadcast(channelinfo["Channels"],
+                                                            "Nobody else joined the quiz game."))
+            self.message_tasks.add(task)
+            task.add_done_callback(self.message_tasks.discard)
+
+    def game_done(self, channelid, channelinfo, task):
+        """Removes a finished game task and records how it went."""
+        _, started = self.games.pop(channelid)
+        if task.cancelled():
+            outcome = "cancelled"
+        elif task.exception() is not None:
+            outcome = "failed"
+            error = task.exception()
+            print("Quiz game in channel {} failed:".format(channelid))
+            traceback.print_exception(type(error), error, error.__traceback__)
+        else:
+            outcome = "finished"
+        self.game_history.append((time.monotonic() - started, outcome))
+
+        # A game that didn't finish normally may have left its state behind.
+        # A new lobby may already be open on the channel, so only this
+        # game's state is removed.
+        self.remove_game(channelid, channelinfo)
 
     async def on_message(self, message):
+        # This runs for every message the bot sees, so reject anything
+        # outside an open question before doing any other work.
+        if message.channel.id not in self.answer_channels:
+            return
+
+        channelinfo = self.playing_channels[message.channel.id]
         authorid = message.author.id
-        channelid = message.channel.id
-        choice = message.content.lower()
-        if channelid in self.playing_channels:
-            channelinfo = self.playing_channels[channelid]
-            if (authorid in channelinfo["Players"]
-                    and authorid not in channelinfo["Answers"]
-                    and choice in {"a", "b", "c", "d"}):
-                channelinfo["Answers"][authorid] = {"Choice":choice,
-                                                    "Time":time.perf_counter()}
+        if authorid not in channelinfo["Players"] or authorid in channelinfo["Answers"]:
+            return
+
+        if len(message.content) > channelinfo["Longest"]:
+            return
+        choice = channelinfo["Lookup"].get(normalize_answer(message.content))
+        if choice is not None:
+            # Answers are timed by when Discord created them, so that
+            # gateway or event loop lag doesn't cost anyone points
+            channelinfo["Answers"][authorid] = {"Choice":choice,
+                                                "Time":message.timestamp,
+                                                "Channel":message.channel.id}
+            self.dispatch_lag.append((datetime.datetime.utcnow()
+                                      - message.timestamp).total_seconds())
+            if len(channelinfo["Answers"]) == len(channelinfo["Players"]):
+                channelinfo["Window"].set() # everyone has answered; end the question now
 
     async def game(self, channel):
-        """Runs a quiz game on a channel."""
+        """Runs a quiz game on a channel. For a tournament, the questions are
+        loaded, timed and scored once here and sent to all of its channels."""
         self.add_server(channel.server)
+        channelinfo = self.playing_channels[channel.id]
+        channels = channelinfo["Channels"]
+        channelinfo["Phase"] = "loading questions"
 
         try:
-            category = await self.category_selector()
-            category_name = await self.category_name(category)
-            response = await self.get_questions(channel.server, category=category)
+            prefetched, (category, raw_questions, questions) = await self.take_prefetch(channel)
         except RuntimeError:
-            await self.bot.send_message(channel, "An error occurred in retrieving questions. "
-                                        "Please try again.")
-            self.playing_channels.pop(channel.id)
+            await self.broadcast(channels, "An error occurred in retrieving questions. "
+                                           "Please try again.")
+            self.remove_game(channel.id)
             raise
+        self.seen_filter(channel.server).add(raw["question"] for raw in raw_questions)
+        self.save_changed = True
+        results = [] # (player ID, difficulty, correct, seconds taken) for every answer
 
-        channelinfo = self.playing_channels[channel.id]
+        ready_time = time.monotonic() - channelinfo["Closed"]
+        category_name = self.category_name(category) or questions[0].category
 
         # Introduction
         intro = ("Welcome to the quiz game! Your category is {}.\n"
                  "Remember to answer correctly as quickly as you can. "
                  "Only your first answer will be registered by the game. "
-                 "You have 10 seconds per question.\n"
-                 "The game will begin shortly.".format(category_name))
-        await self.bot.send_message(channel, intro)
-        await asyncio.sleep(4)
+                 "You have {} seconds per question.\n"
+                 "The game will begin shortly.".format(category_name, self.question_time))
+        if len(channels) > 1:
+            intro = ("This is a tournament across {} channels. Everyone is on "
+                     "the same scoreboard.\n".format(len(channels))) + intro
+        channelinfo["Phase"] = "introduction"
+        await self.broadcast(channels, intro)
+        await asyncio.sleep(self.intro_time)
 
         # Question and Answer
         afk_questions = 0
-        for index, dictionary in enumerate(response["results"]):
-            answers = [dictionary["correct_answer"]] + dictionary["incorrect_answers"]
-
+        for index, question in enumerate(questions):
             # Display question and countdown
-            if len(answers) == 2: # true/false question
-                answers = ["True", "False", "", ""]
-            else:
-                answers = [html.unescape(answer) for answer in answers]
-                random.shuffle(answers)
-
-            message = "```\n"
-            message += "{} ({}/20)\n".format(html.unescape(dictionary["question"]), index + 1)
-            message += "A. {}\n".format(answers[0])
-            message += "B. {}\n".format(answers[1])
-            message += "C. {}\n".format(answers[2])
-            message += "D. {}\n".format(answers[3])
-            message += "```"
-
-            message_obj = await self.bot.send_message(channel, message)
-            await self.bot.add_reaction(message_obj, "0⃣")
-            channelinfo["Answers"].clear() # clear the previous question's answers
-            start_time = time.perf_counter()
-
-            numbers = ["1⃣", "2⃣", "3⃣", "4⃣", "5⃣", "6⃣", "7⃣", "8⃣", "9⃣", "🔟"]
-            for i in range(10):
-                if len(channelinfo["Answers"]) == len(channelinfo["Players"]):
-                    break
-                await asyncio.sleep(1)
-                await self.bot.add_reaction(message_obj, numbers[i])
+            channelinfo["Phase"] = "question {}/{}".format(index + 1, len(questions))
+            messages = await self.broadcast(channels, question.body)
+            if index == 0:
+                self.start_times.append((ready_time, time.monotonic() - channelinfo["Closed"],
+                                         prefetched))
+            if index == len(questions) - PREFETCH_AHEAD:
+                self.prefetch(channel) # in case the players start another game right away
+            # Each channel's answers are timed from that channel's question
+            start_times = {message.channel.id: message.timestamp for message in messages}
+            channelinfo["Lookup"] = question.lookup
+            channelinfo["Longest"] = question.longest
+            channelinfo["Answers"] = {}
+            channelinfo["Window"] = asyncio.Event()
+            self.answer_channels.update(start_times)
+
+            # Wait until everyone has answered or time runs out
+            countdown = self.bot.loop.create_task(self.countdown(messages, question.body))
+            try:
+                await asyncio.wait_for(channelinfo["Window"].wait(), self.question_time)
+            except asyncio.TimeoutError:
+                pass
+            countdown.cancel()
+            self.answer_channels.difference_update(start_times) # stop accepting answers
+            channelinfo["Window"] = None
 
             # Organize answers
-            user_answers = channelinfo["Answers"] # snapshot channelinfo["Answers"] at this point in time
-                                                  # to ignore new answers that are added to it
-            answerdict = {["a", "b", "c", "d"][num]: answers[num] for num in range(4)}
+            user_answers = channelinfo["Answers"]
 
             # Check for AFK
             if len(user_answers) < 2:
                 afk_questions += 1
                 if afk_questions == 3:
-                    await self.bot.send_message(channel, "The game has been cancelled due "
-                                                "to lack of participation.")
-                    self.playing_channels.pop(channel.id)
+                    self.record_stats(channel.server, category, results)
+                    await self.broadcast(channels, "The game has been cancelled due "
+                                                   "to lack of participation.")
+                    self.remove_game(channel.id)
                     return
             else:
                 afk_questions = 0
 
             # Find and display correct answer
-            correct_letter = ""
-            for letter, answer in answerdict.items():
-                if answer == html.unescape(dictionary["correct_answer"]):
-                    correct_letter = letter
-                    break
-            assert answerdict[correct_letter] == html.unescape(dictionary["correct_answer"])
+            correct_letter = "abcd"[question.correct]
             message = "Correct answer:```{}. {}```".format(correct_letter.upper(),
-                                                           answerdict[correct_letter])
-            await self.bot.send_message(channel, message)
+                                                           question.choices[question.correct])
+            await self.broadcast(channels, message)
 
             # Sort player IDs by answer time
-            playerids = sorted(user_answers,
-                               key=lambda playerid: user_answers[playerid]["Time"])
+            times_taken = {}
+            for playerid, answer in user_answers.items():
+                time_taken = (answer["Time"] - start_times[answer["Channel"]]).total_seconds()
+                # in case of clock differences
+                times_taken[playerid] = min(max(time_taken, 0), self.question_time)
+            playerids = sorted(user_answers, key=times_taken.__getitem__)
 
             # Assign scores
             first = True
+            difficulty = raw_questions[index]["difficulty"]
             for playerid in playerids:
-                if user_answers[playerid]["Choice"] == correct_letter:
-                    time_taken = user_answers[playerid]["Time"] - start_time
-                    assert time_taken > 0
+                time_taken = times_taken[playerid]
+                correct = user_answers[playerid]["Choice"] == correct_letter
+                results.append((playerid, difficulty, correct, time_taken))
 
-                    # the 20 in the formula below is 2 * 10s (max answer time)
-                    points = round(1000 * (1 - (time_taken / 20)))
+                if correct:
+                    # the formula below divides by 2 * max answer time
+                    points = round(1000 * (1 - (time_taken / (2 * self.question_time))))
 
                     # The first correct answer gets a bonus 250 points
                     if first:
                         points += 250
                         first = False
 
-                    channelinfo["Players"][playerid] += points
+                    channelinfo["Players"].award(playerid, points)
 
             # Display top 5 players and their points
             message = self.scoreboard(channel)
-            await self.bot.send_message(channel, "Scoreboard:\n" + message)
-            await asyncio.sleep(4)
+            await self.broadcast(channels, "Scoreboard:\n" + message)
+            await asyncio.sleep(self.results_time)
 
-            if index < 19:
-                await self.bot.send_message(channel, "Next question...")
-                await asyncio.sleep(1)
+            if index < len(questions) - 1:
+                await self.broadcast(channels, "Next question...")
+                await asyncio.sleep(self.results_time / 4)
 
         # Ending and Results
+        channelinfo["Phase"] = "ending"
+        self.record_stats(channel.server, category, results)
         await self.end_game(channel)
 
+    async def send(self, channel, content):
+        """Sends a game message once the request budget allows it."""
+        await self.budget.acquire()
+        return await self.bot.send_message(channel, content)
+
+    async def broadcast(self, channels, content):
+        """Sends a game message to each of a game's channels at once.
+        A channel that the message can't be sent to is skipped, so that the
+        game carries on in the others. Returns the messages that were sent."""
+        results = await asyncio.gather(*[self.send(channel, content) for channel in channels],
+                                       return_exceptions=True)
+        messages = []
+        for channel, result in zip(channels, results):
+            if isinstance(result, discord.HTTPException):
+                print("Quiz message to channel {} failed: {}".format(channel.id, result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                messages.append(result)
+        return messages
+
+    async def countdown(self, messages, content):
+        """Counts down a question's 10 seconds on its messages. Runs until it is
+        cancelled when the question ends. Updates are skipped while the
+        request budget is used up, since the countdown is only cosmetic."""
+        mode = self.save_file["Global"]["Countdown"]
+        second = self.question_time / 10 # shorter than a second in the load simulator
+        if mode == "reactions":
+            numbers = ["0⃣", "1⃣", "2⃣", "3⃣", "4⃣", "5⃣", "6⃣", "7⃣", "8⃣", "9⃣", "🔟"]
+            for index, number in enumerate(numbers):
+                if index:
+                    await asyncio.sleep(second)
+                for message in messages:
+                    if self.budget.try_acquire():
+                        await self.bot.add_reaction(message, number)
+        elif mode == "edit":
+            for remaining in range(10 - COUNTDOWN_EDIT_INTERVAL, 0, -COUNTDOWN_EDIT_INTERVAL):
+                await asyncio.sleep(COUNTDOWN_EDIT_INTERVAL * second)
+                for message in messages:
+                    if self.budget.try_acquire():
+                        await self.bot.edit_message(message, "{}\n{} seconds left"
+                                                    .format(content, remaining))
+
     async def end_game(self, channel):
         """Ends a quiz game."""
-        # non-linear credit earning .0002x^{2.9} where x is score/100
         # leaderboard with credits earned
-        channelinfo = self.playing_channels[channel.id]
-        idlist = sorted(channelinfo["Players"],
-                        key=(lambda idnum: channelinfo["Players"][idnum]),
-                        reverse=True)
+        channels = self.playing_channels[channel.id]["Channels"]
+        players = self.playing_channels[channel.id]["Players"]
+        ranked = players.top()
 
-        winner = channel.server.get_member(idlist[0])
-        await self.bot.send_message(channel, "Game over! {} won!".format(winner.mention))
+        await self.broadcast(channels, "Game over! <@{}> won!".format(ranked[0][0]))
 
-        bank = self.bot.get_cog("Economy").bank
-        leaderboard = "```py\n"
-        max_credits = self.calculate_credits(channelinfo["Players"][idlist[0]])
-        end_len = len(str(max_credits)) + 1 # the 1 is for a space between a max length name and the score
-        rank_len = len(str(len(channelinfo["Players"])))
-        rank = 1
-        no_account = False
-        for playerid in idlist:
-            player = channel.server.get_member(playerid)
-            account_exists = bank.account_exists(player) # how does this know what server it's called in???
-
-            if account_exists:
-                if len(player.display_name) > 25 - rank_len - end_len:
-                    name = player.display_name[:22 - rank_len - end_len] + "..."
+        payouts = [(playerid, self.calculate_credits(score)) for playerid, score in ranked]
+        no_account = self.pay_players(channel.server, payouts)
+
+        end_len = len(str(payouts[0][1])) + 1 # the 1 is for a space between a max length name and the score
+        rank_len = len(str(len(players)))
+        lines = []
+        for rank, (playerid, creds) in enumerate(payouts, 1):
+            display_name = players.names[playerid]
+            if playerid not in no_account:
+                if len(display_name) > 25 - rank_len - end_len:
+                    name = display_name[:22 - rank_len - end_len] + "..."
                 else:
-                    name = player.display_name
+                    name = display_name
             else:
-                if len(player.display_name) > 24 - rank_len - end_len:
-                    name = player.display_name[:21 - rank_len - end_len] + "...*"
+                if len(display_name) > 24 - rank_len - end_len:
+                    name = display_name[:21 - rank_len - end_len] + "...*"
                 else:
-                    name = player.display_name + "*"
-
-            leaderboard += str(rank)
-            leaderboard += " " * (1 + rank_len - len(str(rank)))
-            leaderboard += name
-            creds = self.calculate_credits(channelinfo["Players"][playerid])
-            creds_str = str(creds)
-            leaderboard += " " * (26 - rank_len - 1 - len(name) - len(creds_str))
-            leaderboard += creds_str + "\n"
-
-            if account_exists:
-                bank.deposit_credits(player, creds)
-            else:
-                no_account = True
+                    name = display_name + "*"
 
-            rank += 1
+            lines.append("{:<{}}{}{:>{}}\n".format(rank, rank_len + 1, name,
+                                                    creds, 25 - rank_len - len(name)))
 
-        if not no_account:
-            leaderboard += "```"
-        else:
-            leaderboard += ("* because you do not have a bank account, "
-                            "you did not get to keep the credits you won.```\n")
+        footer = ""
+        if no_account:
+            footer = ("* because you do not have a bank account, "
+                      "you did not get to keep the credits you won.\n")
+
+        # Split big leaderboards to stay under Discord's message length limit
+        title = "Credits earned:\n"
+        for start in range(0, len(lines), 60):
+            leaderboard = "```py\n" + "".join(lines[start:start + 60])
+            if start + 60 >= len(lines):
+                leaderboard += footer
+            await self.broadcast(channels, title + leaderboard + "```")
+            title = ""
+        self.remove_game(channel.id)
 
-        await self.bot.send_message(channel, "Credits earned:\n" + leaderboard)
-        self.playing_channels.pop(channel.id)
+    def pay_players(self, server, payouts):
+        """Deposits credits for many players at once. payouts is a list of
+        (player ID, credits). Returns a set of the IDs of players who don't
+        have a bank account.
+
+        Economy's bank saves its whole file on every deposit, so when its
+        accounts can be reached they are updated directly and saved once."""
+        bank = self.bot.get_cog("Economy").bank
+        no_account = set()
+        accounts = getattr(bank, "accounts", None)
+        if isinstance(accounts, dict) and hasattr(bank, "_save_bank"):
+            server_accounts = accounts.get(server.id, {})
+            for playerid, creds in payouts:
+                if playerid in server_accounts:
+                    server_accounts[playerid]["balance"] += creds
+                else:
+                    no_account.add(playerid)
+            bank._save_bank()
+        else:
+            for playerid, creds in payouts:
+                player = server.get_member(playerid)
+                if bank.account_exists(player):
+                    bank.deposit_credits(player, creds)
+                else:
+                    no_account.add(playerid)
+        return no_account
 
     def scoreboard(self, channel):
         """Returns a scoreboard string to be sent to the text channel."""
-        channelinfo = self.playing_channels[channel.id]
+        players = self.playing_channels[channel.id]["Players"]
         scoreboard = "```py\n"
-        idlist = sorted(channelinfo["Players"],
-                        key=(lambda idnum: channelinfo["Players"][idnum]),
-                        reverse=True)
-        max_score = channelinfo["Players"][idlist[0]]
+        leaders = players.top(5)
+        max_score = leaders[0][1]
         end_len = len(str(max_score)) + 1
         rank = 1
-        for playerid in idlist[:5]:
-            player = channel.server.get_member(playerid)
-            if len(player.display_name) > 24 - end_len:
-                name = player.display_name[:21 - end_len] + "..."
+        for playerid, score in leaders:
+            display_name = players.names[playerid]
+            if len(display_name) > 24 - end_len:
+                name = display_name[:21 - end_len] + "..."
             else:
-                name = player.display_name
+                name = display_name
             scoreboard += str(rank) + " " + name
-            score_str = str(channelinfo["Players"][playerid])
+            score_str = str(score)
             scoreboard += " " * (24 - len(name) - len(score_str))
             scoreboard += score_str + "\n"
             rank += 1
@@ -296,108 +977,363 @@ class Quiz:
 
     def calculate_credits(self, score):
         """Calculates credits earned from a score."""
-        adjusted = score / 100
-        if adjusted < 156.591:
-            result = .0002 * (adjusted**2.9)
+        if 0 <= score <= MAX_SCORE:
+            return CREDIT_TABLE[score]
+        return credit_curve(score)
+
+    async def load_questions(self, server):
+        """Gets the category and questions for a game, from the bank if it can.
+        Returns the category, the questions as OTDB dicts and as Questions."""
+        amount = self.questions_per_game
+        difficulty = self.difficulty_selector(server)
+        # Fresh questions of any difficulty come before questions the server
+        # has seen, so that a server isn't given repeats the bank can avoid
+        for repeats, wanted in ((False, difficulty), (False, None),
+                                (True, difficulty), (True, None)):
+            category, questions = self.draw_questions(server, amount, wanted, repeats)
+            if questions is not None:
+                break
         else:
-            result = (.6625 * math.exp(.0411 * adjusted)) + 50
+            # The bank can't supply a game yet, so go to OTDB directly
+            try:
+                category = self.category_selector(server=server, difficulty=difficulty)
+                questions = await self.get_questions(server, category, difficulty, amount)
+            except RuntimeError:
+                # Not enough questions of that difficulty; any will do
+                category = self.category_selector(server=server)
+                questions = await self.get_questions(server, category, amount=amount)
+
+        # Decode, shuffle and render every question before the game begins
+        records = [make_question(raw, index + 1, len(questions))
+                   for index, raw in enumerate(questions)]
+        return category, questions, records
+
+    def prefetch(self, channel):
+        """Starts loading the questions for the channel's next game."""
+        if channel.id in self.prefetches:
+            return
+        self.add_server(channel.server)
+        task = self.bot.loop.create_task(self.load_questions(channel.server))
+        timer = self.bot.loop.call_later(PREFETCH_TTL, self.expire_prefetch, channel.id)
+        self.prefetches[channel.id] = (task, timer)
+
+    async def take_prefetch(self, channel):
+        """Returns whether the channel's questions were already loaded and the
+        result of load_questions, starting to load them now if necessary."""
+        self.prefetch(channel)
+        task, timer = self.prefetches.pop(channel.id)
+        timer.cancel()
+        return task.done(), await task
+
+    def expire_prefetch(self, channelid):
+        """Discards a channel's prefetched questions that no game used."""
+        task, timer = self.prefetches.pop(channelid)
+        timer.cancel()
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception() # retrieve it so that it isn't logged as unhandled
+
+    def draw_questions(self, server, amount=20, difficulty=None, repeats=False):
+        """Draws questions the server hasn't seen from a random category in
+        the bank. With repeats, questions the server has seen make up the
+        numbers, so that a bank that can't be refilled keeps serving games.
+        Returns (None, None) if no category has enough questions."""
+        seen = self.seen_filter(server)
+        categories = self.bank.categories(amount, difficulty)
+        for _ in range(5):
+            if not categories:
+                break
+            category = self.category_selector(categories, server)
+            questions = self.bank.draw(category, amount, difficulty, seen, repeats)
+            if questions is not None:
+                return category, questions
+            categories.remove(category)
+        return None, None
+
+    def seen_filter(self, server):
+        """Returns the server's SeenFilter."""
+        if server.id not in self.seen:
+            self.seen[server.id] = SeenFilter(self.save_file["Servers"][server.id]["Seen"])
+        return self.seen[server.id]
 
-        return round(result)
+    async def bank_loop(self):
+        """Keeps each pool in the question bank topped up from OTDB."""
+        while True:
+            try:
+                await self.fill_bank()
+            except (RuntimeError, KeyError) as error:
+                # OTDB is unreachable or misbehaving; the bank keeps
+                # serving what it already has until the next attempt.
+                print("Quiz bank fill stopped: {}".format(error))
+            self.bank.save()
+            if self.save_changed:
+                self.save()
+                self.save_changed = False
+            await asyncio.sleep(BANK_REFILL_INTERVAL)
+
+    async def fill_bank(self):
+        """Fetches questions for every pool that is below BANK_POOL_SIZE."""
+        for category in self.category_ids():
+            for difficulty in DIFFICULTIES:
+                available = self.question_count(category, difficulty)
+                if available is None:
+                    available = BANK_POOL_SIZE
+                missing = min(BANK_POOL_SIZE, available) - self.bank.count(category, difficulty)
+                if missing <= 0:
+                    continue
+                parameters = {"amount": min(missing, 50), # OTDB's maximum
+                              "category": category,
+                              "difficulty": difficulty}
+                response_json = await self.api_get("api.php", parameters)
+                # Response code 1 means the pool's category and difficulty
+                # don't have that many questions. Try again next time.
+                if response_json["response_code"] == 0:
+                    self.bank.add(category, difficulty, response_json["results"])
 
 # OpenTriviaDB API functions
-    async def get_questions(self, server, category=None, difficulty=None):
-        """Gets questions, resetting a token or getting a new one if necessary."""
-        parameters = {"amount": 20}
-        if category:
-            parameters["category"] = category
+    async def api_get(self, endpoint, params=None):
+        """Sends a GET request to an OTDB endpoint and returns the decoded JSON.
+
+        Every request the cog makes goes through here one at a time, at least
+        API_INTERVAL seconds apart. Timeouts, connection errors, HTTP 429 and
+        5xx statuses, and OTDB's rate limit response code are retried with
+        jittered exponential backoff."""
+        for attempt in range(API_RETRIES):
+            if attempt:
+                delay = API_BACKOFF * 2**(attempt - 1)
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+            try:
+                async with self.api_lock:
+                    wait = self.api_last + API_INTERVAL - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    try:
+                        status, response_json = await asyncio.wait_for(
+                            self.api_request(endpoint, params), API_TIMEOUT)
+                    finally:
+                        self.api_last = time.monotonic()
+            except (asyncio.TimeoutError, aiohttp.ClientError, ValueError):
+                continue
+
+            if status == 429 or status >= 500:
+                continue
+            if status != 200:
+                raise RuntimeError("OTDB returned HTTP status {}.".format(status))
+            if response_json.get("response_code") == 5: # rate limited
+                continue
+            return response_json
+
+        raise RuntimeError("OTDB request to {} failed after {} attempts."
+                           .format(endpoint, API_RETRIES))
+
+    async def api_request(self, endpoint, params):
+        """Makes one request with the cog's session. Returns the HTTP
+        status and, if the request succeeded, the decoded JSON."""
+        async with self.session.get(API_URL + endpoint, params=params) as response:
+            if response.status != 200:
+                return response.status, None
+            return response.status, await response.json()
+
+    async def get_questions(self, server, category, difficulty=None, amount=20):
+        """Gets questions from OTDB, preferring ones the server hasn't seen.
+        The questions are also added to the bank."""
+        parameters = {"amount": 50, "category": category} # 50 is OTDB's maximum
         if difficulty:
             parameters["difficulty"] = difficulty
-        for _ in range(3):
-            parameters["token"] = await self.get_token(server)
-            async with aiohttp.get("https://opentdb.com/api.php",
-                                   params=parameters) as response:
-
-                response_json = await response.json()
-                response_code = response_json["response_code"]
-                if response_code == 0:
-                    return response_json
-                elif response_code == 1:
-                    raise RuntimeError("Question retrieval unsuccessful. Response "
-                                       "code from OTDB: 1")
-                elif response_code == 2:
-                    raise RuntimeError("Question retrieval unsuccessful. Response "
-                                       "code from OTDB: 2")
-                elif response_code == 3:
-                    # Token expired. Obtain new one.
-                    print("Response code from OTDB: 3")
-                    self.save_file["Servers"][server.id]["Token"] = ""
-                    dataIO.save_json(SAVE_FILEPATH, self.save_file)
-                elif response_code == 4:
-                    # Token empty. Reset it.
-                    print("Response code from OTDB: 4")
-                    await self.reset_token(server)
-        raise RuntimeError("Failed to retrieve questions.")
-
-    async def get_token(self, server):
-        """Gets the provided server's token, or generates
-        and saves one if one doesn't exist."""
-        if self.save_file["Servers"][server.id]["Token"]:
-            token = self.save_file["Servers"][server.id]["Token"]
-        else:
-            async with aiohttp.get("https://opentdb.com/api_token.php",
-                                   params={"command": "request"}) as response:
-                response_json = await response.json()
-                token = response_json["token"]
-                self.save_file["Servers"][server.id]["Token"] = token
-                dataIO.save_json(SAVE_FILEPATH, self.save_file)
-
-        return token
-
-    async def reset_token(self, server):
-        """Resets the provided server's token."""
-        token = self.save_file["Servers"][server.id]["Token"]
-        async with aiohttp.get("https://opentdb.com/api_token.php",
-                               params={"command": "reset", "token": token}) as response:
-            response_code = (await response.json())["response_code"]
-            if response_code != 0:
-                raise RuntimeError("Token reset was unsuccessful. Response code from "
-                                   "OTDB: {}".format(response_code))
-
-    async def category_selector(self):
-        """Chooses a random category that has enough questions."""
-        for _ in range(10):
-            category = random.randint(9, 32)
-            async with aiohttp.get("https://opentdb.com/api_count.php",
-                                   params={"category": category}) as response:
-                response_json = await response.json()
-                assert response_json["category_id"] == category
-                if response_json["category_question_count"]["total_question_count"] > 39:
-                    return category
-
-        raise RuntimeError("Failed to select a category.")
-
-    async def category_name(self, idnum):
-        """Finds a category's name from its number."""
-        async with aiohttp.get("https://opentdb.com/api_category.php") as response:
-            response_json = await response.json()
-            for cat_dict in response_json["trivia_categories"]:
-                if cat_dict["id"] == idnum:
-                    return cat_dict["name"]
-        raise RuntimeError("Failed to find category's name.")
+        response_json = await self.api_get("api.php", parameters)
+        if response_json["response_code"] == 1:
+            # The category doesn't have 50 questions; ask for fewer
+            parameters["amount"] = amount
+            response_json = await self.api_get("api.php", parameters)
+
+        response_code = response_json["response_code"]
+        if response_code != 0:
+            raise RuntimeError("Question retrieval unsuccessful. Response "
+                               "code from OTDB: {}".format(response_code))
+
+        questions = response_json["results"]
+        for diff in DIFFICULTIES:
+            self.bank.add(category, diff, [question for question in questions
+                                           if question["difficulty"] == diff])
+
+        seen = self.seen_filter(server)
+        questions.sort(key=lambda question: question["question"] in seen) # unseen first
+        return questions[:amount]
+
+    async def category_loop(self):
+        """Refreshes the category cache whenever it is older than CATEGORY_TTL."""
+        while True:
+            wait = self.categories["Updated"] + CATEGORY_TTL - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await self.refresh_categories()
+            except (RuntimeError, KeyError) as error:
+                print("Quiz category refresh failed: {}".format(error))
+                await asyncio.sleep(BANK_REFILL_INTERVAL)
+
+    async def refresh_categories(self):
+        """Downloads every category's name and question counts and saves them."""
+        category_list = (await self.api_get("api_category.php"))["trivia_categories"]
+
+        cached = {}
+        for cat_dict in category_list:
+            response_json = await self.api_get("api_count.php", {"category": cat_dict["id"]})
+            counts = response_json["category_question_count"]
+            cached[str(cat_dict["id"])] = {
+                "Name": cat_dict["name"],
+                "Counts": {"total": counts["total_question_count"],
+                           "easy": counts["total_easy_question_count"],
+                           "medium": counts["total_medium_question_count"],
+                           "hard": counts["total_hard_question_count"]}
+            }
+
+        self.categories = {"Updated": time.time(), "Categories": cached}
+        dataIO.save_json(CATEGORIES_FILEPATH, self.categories)
+
+    def category_ids(self):
+        """Lists the IDs of all known categories."""
+        if self.categories["Categories"]:
+            return [int(category) for category in self.categories["Categories"]]
+        return list(CATEGORIES)
+
+    def question_count(self, category, difficulty="total"):
+        """Returns the cached number of OTDB questions in a category,
+        or None if the category isn't in the cache."""
+        cat_dict = self.categories["Categories"].get(str(category))
+        if cat_dict is None:
+            return None
+        return cat_dict["Counts"][difficulty]
+
+    def category_selector(self, candidates=None, server=None, difficulty=None):
+        """Chooses a random category that has enough questions. Categories
+        with more questions are more likely to be chosen. If a server is
+        given, so are categories where its correct answer rate is near
+        STATS_TARGET."""
+        difficulty = difficulty or "total"
+        if candidates is None:
+            candidates = [category for category in self.category_ids()
+                          if self.question_count(category, difficulty) is None
+                          or self.question_count(category, difficulty) > 39]
+        if not candidates:
+            raise RuntimeError("Failed to select a category.")
+
+        weights = [self.question_count(category, difficulty) or 1 for category in candidates]
+        if server is not None:
+            rollup = self.save_file["Servers"][server.id]["Stats"]["Categories"]
+            weights = [weight * (1 - abs(accuracy(rollup.get(str(category)), STATS_TARGET)
+                                         - STATS_TARGET))
+                       for weight, category in zip(weights, candidates)]
+        return weighted_choice(candidates, weights)
+
+    def difficulty_selector(self, server):
+        """Chooses the difficulty where the server's correct answer rate is
+        closest to STATS_TARGET. Sometimes chooses randomly instead."""
+        if random.random() < STATS_EXPLORE:
+            return random.choice(DIFFICULTIES)
+        rollup = self.save_file["Servers"][server.id]["Stats"]["Difficulties"]
+        return min(DIFFICULTIES, key=lambda difficulty: abs(
+            accuracy(rollup.get(difficulty), STATS_PRIORS[difficulty]) - STATS_TARGET))
+
+    def category_name(self, idnum):
+        """Finds a category's name from its number, or returns None
+        if the category isn't in the cache."""
+        cat_dict = self.categories["Categories"].get(str(idnum))
+        if cat_dict is None:
+            return None
+        return cat_dict["Name"]
 
 # Other functions
+    def record_stats(self, server, category, results):
+        """Adds a game's answers to the server's stats and to the stats log.
+        results is a list of (player ID, difficulty, correct, seconds taken)."""
+        if not results:
+            return
+        stats = self.save_file["Servers"][server.id]["Stats"]
+        for playerid, difficulty, correct, seconds in results:
+            add_stats(stats["Difficulties"].setdefault(difficulty, [0, 0, 0]), correct, seconds)
+            add_stats(stats["Categories"].setdefault(str(category), [0, 0, 0]), correct, seconds)
+            add_stats(stats["Players"].setdefault(playerid, [0, 0, 0]), correct, seconds)
+        self.save_changed = True
+
+        self.log_stats({"Time": int(time.time()),
+                        "Server": server.id,
+                        "Category": category,
+                        "Answers": [[playerid, difficulty, int(correct), round(seconds, 3)]
+                                    for playerid, difficulty, correct, seconds in results]})
+
+    def log_stats(self, entry):
+        """Appends an entry to the stats log."""
+        with open(STATS_FILEPATH, "a") as stats_log:
+            stats_log.write(json.dumps(entry) + "\n")
+
     def add_server(self, server):
         """Adds the server to the file if it isn't already in it."""
         if server.id not in self.save_file["Servers"]:
-            self.save_file["Servers"][server.id] = {"Token": ""}
-            dataIO.save_json(SAVE_FILEPATH, self.save_file)
+            self.save_file["Servers"][server.id] = copy.deepcopy(SERVER_DEFAULT)
+            self.save()
 
         return
 
+    def load_files(self):
+        """Reads the save file, the question bank and the category cache."""
+        self.save_file = dataIO.load_json(SAVE_FILEPATH)
+        self.update_version()
+        self.bank = QuestionBank(BANK_FILEPATH)
+        self.categories = dataIO.load_json(CATEGORIES_FILEPATH)
+
+    def start_tasks(self):
+        """Opens the OTDB session and starts the background tasks."""
+        # One keep-alive session for every OTDB request the cog makes
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=1)) # api_get sends one request at a time
+
+        self.bank_task = self.bot.loop.create_task(self.bank_loop())
+        self.category_task = self.bot.loop.create_task(self.category_loop())
+
+    def update_version(self):
+        """Updates the save file if necessary."""
+        if "Global" not in self.save_file: # if version 1
+            self.save_file["Global"] = {"Countdown": "edit", "Version": "2"}
+
+        if self.save_file["Global"]["Version"] == "2":
+            # Per-server OTDB tokens were replaced by seen filters
+            for serverid in self.save_file["Servers"]:
+                self.save_file["Servers"][serverid] = copy.deepcopy(SERVER_DEFAULT)
+            self.save_file["Global"]["Version"] = "3"
+
+        if self.save_file["Global"]["Version"] == "3":
+            for serverid in self.save_file["Servers"]:
+                self.save_file["Servers"][serverid]["Stats"] = copy.deepcopy(
+                    SERVER_DEFAULT["Stats"])
+            self.save_file["Global"]["Version"] = "4"
+
+        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+
+    def save(self):
+        """Writes the save file."""
+        dataIO.save_json(SAVE_FILEPATH, self.save_file)
+
     def __unload(self):
-        self.starter_task.cancel()
-        for task in self.game_tasks:
+        for timer in self.lobby_timers.values():
+            timer.cancel()
+        for task, _ in list(self.games.values()):
+            task.cancel()
+        for task in list(self.message_tasks):
             task.cancel()
+        for channelid in list(self.prefetches):
+            self.expire_prefetch(channelid)
+        self.bank_task.cancel()
+        self.category_task.cancel()
+        self.bank.save()
+        if self.save_changed:
+            self.save()
+
+        # ClientSession.close is a coroutine in newer versions of aiohttp
+        closing = self.session.close()
+        if inspect.isawaitable(closing):
+            asyncio.ensure_future(closing)
 
 def dir_check():
     """Creates a folder and save file for the cog if they don't exist."""
@@ -407,7 +1343,15 @@ def dir_check():
 
     if not dataIO.is_valid_json(SAVE_FILEPATH):
         print("Creating default quiz.json...")
-        dataIO.save_json(SAVE_FILEPATH, {"Servers": {}})
+        dataIO.save_json(SAVE_FILEPATH, SAVE_DEFAULT)
+
+    if not dataIO.is_valid_json(BANK_FILEPATH):
+        print("Creating default bank.json...")
+        dataIO.save_json(BANK_FILEPATH, {"Pools": {}})
+
+    if not dataIO.is_valid_json(CATEGORIES_FILEPATH):
+        print("Creating default categories.json...")
+        dataIO.save_json(CATEGORIES_FILEPATH, {"Updated": 0, "Categories": {}})
 
 def setup(bot):
     """Creates a Quiz object."""
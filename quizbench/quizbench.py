@@ -0,0 +1,332 @@
+"""Owner commands that benchmark the quiz cog."""
+import asyncio
+import collections
+import copy
+import datetime
+import random
+import time
+import types
+
+from discord.ext import commands
+from .utils import checks
+from .quiz import (Quiz, QuestionBank, RequestBudget, Scoreboard, make_question, deep_sizeof,
+                   SAVE_DEFAULT, DIFFICULTIES, BUDGET_RATE, BUDGET_BURST)
+
+def fake_message(channelid, authorid, content):
+    """Builds a stand-in for a discord.Message."""
+    return types.SimpleNamespace(channel=types.SimpleNamespace(id=channelid),
+                                 author=types.SimpleNamespace(id=authorid),
+                                 content=content,
+                                 timestamp=datetime.datetime.utcnow())
+
+def run_now(coro):
+    """Runs a coroutine that never suspends to completion without the event loop."""
+    try:
+        coro.send(None)
+    except StopIteration:
+        pass
+    else:
+        raise RuntimeError("Coroutine suspended.")
+
+class FakeBot:
+    """Stands in for the bot in the load simulator. Messages are dropped,
+    and every player answers each question after a random delay."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.quiz = None # set by SimulatedQuiz
+        self.channels = {} # channel IDs as keys and fake channels as values
+        self.players = {} # channel IDs as keys and lists of player IDs as values
+        self.accounts = {} # server IDs as keys and Economy-like accounts as values
+        self.rounds = [] # seconds between consecutive questions in a channel
+        self.last_question = {} # channel IDs as keys and when the last question was sent
+        self.answers = 0
+        self.answer_time = 0 # seconds spent in on_message for answers
+
+    def add_channel(self, channelid, players):
+        """Creates a channel on its own server and returns it with its players."""
+        server = types.SimpleNamespace(id="server " + channelid, get_member=lambda _: None)
+        channel = types.SimpleNamespace(id=channelid, server=server)
+        members = [types.SimpleNamespace(id="{} player {}".format(channelid, num),
+                                         display_name="Player {}".format(num))
+                   for num in range(players)]
+        self.channels[channelid] = channel
+        self.players[channelid] = [member.id for member in members]
+        self.accounts[server.id] = {member.id: {"balance": 0} for member in members}
+        return channel, members
+
+    def get_channel(self, channelid):
+        return self.channels.get(channelid)
+
+    def get_cog(self, name):
+        bank = types.SimpleNamespace(accounts=self.accounts, _save_bank=lambda: None)
+        return types.SimpleNamespace(bank=bank)
+
+    async def send_message(self, channel, content):
+        message = types.SimpleNamespace(channel=channel, content=content,
+                                        timestamp=datetime.datetime.utcnow())
+        if content.startswith("```\n"): # a question
+            now = time.monotonic()
+            if channel.id in self.last_question:
+                self.rounds.append(now - self.last_question[channel.id])
+            self.last_question[channel.id] = now
+            for playerid in self.players[channel.id]:
+                self.loop.call_later(random.uniform(0.1, 0.9) * self.quiz.question_time,
+                                     self.answer, channel.id, playerid)
+        return message
+
+    async def edit_message(self, message, content):
+        return message
+
+    async def add_reaction(self, message, emoji):
+        pass
+
+    def answer(self, channelid, playerid):
+        """Sends a random answer to on_message and times it."""
+        message = fake_message(channelid, playerid, random.choice("abcd"))
+        start = time.perf_counter()
+        run_now(self.quiz.on_message(message))
+        self.answer_time += time.perf_counter() - start
+        self.answers += 1
+
+class SimulatedQuiz(Quiz):
+    """A Quiz for benchmarks. It keeps nothing on disk, starts no background
+    tasks and gets its questions from a local stand-in for OTDB."""
+
+    def __init__(self, bot):
+        super().__init__(bot)
+        bot.quiz = self
+        self.generated = 0
+
+    def load_files(self):
+        self.save_file = copy.deepcopy(SAVE_DEFAULT)
+        self.bank = QuestionBank(None)
+        self.categories = {"Updated": 0, "Categories": {}}
+
+    def start_tasks(self):
+        pass
+
+    def save(self):
+        pass
+
+    def log_stats(self, entry):
+        pass
+
+    async def api_get(self, endpoint, params=None):
+        await asyncio.sleep(0.05) # roughly a request to OTDB
+        if endpoint != "api.php":
+            raise RuntimeError("The simulated OTDB only has api.php.")
+        results = []
+        for _ in range(params.get("amount", 10)):
+            self.generated += 1
+            results.append({"category": "Simulation",
+                            "type": "multiple",
+                            "difficulty": params.get("difficulty") or random.choice(DIFFICULTIES),
+                            "question": "Simulated question {}".format(self.generated),
+                            "correct_answer": "Right",
+                            "incorrect_answers": ["Wrong", "Also wrong", "Not right"]})
+        return {"response_code": 0, "results": results}
+
+async def simulate_load(loop, channels, players, questions, scale):
+    """Runs one simulated quiz game on each of the given number of channels
+    at once. Returns a dict of measurements."""
+    bot = FakeBot(loop)
+    quiz = SimulatedQuiz(bot)
+    quiz.timeout *= scale
+    quiz.question_time *= scale
+    quiz.intro_time *= scale
+    quiz.results_time *= scale
+    quiz.questions_per_game = questions
+    quiz.budget = RequestBudget(BUDGET_RATE / scale, BUDGET_BURST)
+
+    # Measure how late a short sleep wakes up while the games run
+    lags = []
+    memory = []
+    async def monitor():
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(0.01)
+            lags.append(time.monotonic() - start - 0.01)
+            if not memory:
+                playing = [info for info in quiz.playing_channels.values()
+                           if info["Phase"].startswith("question")]
+                if len(playing) == channels:
+                    memory.extend(deep_sizeof(info) for info in playing)
+    monitor_task = loop.create_task(monitor())
+
+    for num in range(channels):
+        channel, members = bot.add_channel(str(num), players)
+        quiz.open_lobby(channel, members[0])
+        for member in members[1:]:
+            quiz.playing_channels[channel.id]["Players"].add(member.id, member.display_name)
+
+    try:
+        while quiz.lobby_timers or quiz.games:
+            await asyncio.sleep(0.1)
+    finally:
+        monitor_task.cancel()
+        for timer in quiz.lobby_timers.values():
+            timer.cancel()
+        for task, _ in quiz.games.values():
+            task.cancel()
+        for channelid in list(quiz.prefetches):
+            quiz.expire_prefetch(channelid)
+
+    # A game's questions are held by its task, so measure a batch separately
+    server = types.SimpleNamespace(id="memory")
+    quiz.add_server(server)
+    batch = await quiz.load_questions(server)
+
+    rounds = bot.rounds or [0]
+    return {"Lag": sum(lags) / len(lags) if lags else 0,
+            "Max lag": max(lags, default=0),
+            "Round": sum(rounds) / len(rounds),
+            "Max round": max(rounds),
+            "Memory": (sum(memory) / len(memory) if memory else 0) + deep_sizeof(batch),
+            "Throughput": bot.answers / bot.answer_time if bot.answer_time else 0,
+            "Failed": sum(1 for _, outcome in quiz.game_history if outcome != "finished")}
+
+class QuizBench:
+    """Benchmarks for the quiz cog. They run on their own Quiz objects, so
+    the quiz cog needs to be installed but not loaded, and its games and
+    data are left alone."""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def quizbench(self, ctx, name: str = "listener"):
+        """Run a benchmark of the quiz cog and show the results.
+
+        listener: the cost of on_message per message
+        scoreboard: the cost of scoring a round for 10 to 1000 players
+        load: simulated games on 1 to 500 channels at once (takes a few minutes)
+
+        The load simulation shares the bot's event loop, so the bot
+        responds slowly while it runs. It makes no Discord or OTDB requests."""
+        if name == "listener":
+            report = self.benchmark_listener()
+        elif name == "scoreboard":
+            report = self.benchmark_scoreboard()
+        elif name == "load":
+            await self.bot.say("Running the load simulation...")
+            report = await self.benchmark_load()
+        else:
+            return await self.bot.say("Unknown benchmark.")
+        return await self.bot.say("```\n{}```".format(report))
+
+    def benchmark_listener(self, iterations=100000):
+        """Times on_message for messages that aren't answers and for answers.
+        Returns a report with the average cost of each kind of message."""
+        quiz = SimulatedQuiz(FakeBot(self.bot.loop))
+        channelid = "benchmark"
+        question = make_question({"category": "Entertainment: Video Games",
+                                  "question": "Which game came first?",
+                                  "correct_answer": "Pok&eacute;mon Red",
+                                  "incorrect_answers": ["Pok&eacute;mon Gold",
+                                                        "Pok&eacute;mon Ruby",
+                                                        "Pok&eacute;mon Diamond"]}, 1, 1)
+        channelinfo = {"Started": True,
+                       "Players": Scoreboard(),
+                       "Answers": {},
+                       "Lookup": question.lookup,
+                       "Longest": question.longest,
+                       "Window": asyncio.Event()}
+        for num in range(100):
+            channelinfo["Players"].add(str(num), "Player {}".format(num))
+        cases = [("Other channel", fake_message("elsewhere", "0", "chatter " * 100)),
+                 ("Game channel, not a player", fake_message(channelid, "outsider", "a")),
+                 ("Game channel, not an answer", fake_message(channelid, "0", "chatter " * 100)),
+                 ("Game channel, short chatter", fake_message(channelid, "0", "no idea lol")),
+                 ("Answer", fake_message(channelid, "0", "a")),
+                 ("Answer by text", fake_message(channelid, "0", "pokemon red")),
+                 ("Answer by text with accents", fake_message(channelid, "0", "Pokémon Red!"))]
+
+        quiz.playing_channels[channelid] = channelinfo
+        quiz.answer_channels.add(channelid)
+        quiz.dispatch_lag = collections.deque(maxlen=1)
+
+        # Answers are cleared every iteration so that the answer is always accepted
+        start = time.perf_counter()
+        for _ in range(iterations):
+            channelinfo["Answers"].clear()
+        overhead = time.perf_counter() - start
+
+        report = "{} messages per case\n".format(iterations)
+        for label, message in cases:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                channelinfo["Answers"].clear()
+                run_now(quiz.on_message(message))
+            elapsed = time.perf_counter() - start - overhead
+            report += "{}: {:.0f} ns\n".format(label, elapsed / iterations * 1e9)
+        return report
+
+    def benchmark_scoreboard(self, rounds=20):
+        """Times scoring a game of 10, 100 and 1000 players, where about half
+        of the players score each round and the top 5 are shown after every
+        round. Compares Scoreboard with sorting a dict of scores every round."""
+        report = "Average per round, {} rounds\n".format(rounds)
+        for size in (10, 100, 1000):
+            playerids = [str(num) for num in range(size)]
+            points = [[(playerid, random.randint(250, 1250)) for playerid in playerids
+                       if random.random() < 0.5] for _ in range(rounds)]
+
+            players = Scoreboard()
+            for playerid in playerids:
+                players.add(playerid, playerid)
+            start = time.perf_counter()
+            for round_points in points:
+                for playerid, amount in round_points:
+                    players.award(playerid, amount)
+                players.top(5)
+            incremental = (time.perf_counter() - start) / rounds
+
+            start = time.perf_counter()
+            for playerid in playerids:
+                players.rank(playerid)
+            rank_lookup = (time.perf_counter() - start) / size
+
+            scores = {playerid: 0 for playerid in playerids}
+            start = time.perf_counter()
+            for round_points in points:
+                for playerid, amount in round_points:
+                    scores[playerid] += amount
+                sorted(scores, key=(lambda idnum: scores[idnum]), reverse=True)[:5]
+            resort = (time.perf_counter() - start) / rounds
+
+            report += ("{} players: Scoreboard {:.3f} ms, re-sort {:.3f} ms, "
+                       "rank lookup {:.2f} us\n".format(size, incremental * 1000,
+                                                        resort * 1000, rank_lookup * 1e6))
+        return report
+
+    async def benchmark_load(self, channel_counts=(1, 10, 50, 100, 500),
+                             players=4, questions=5, scale=0.05):
+        """Runs simulated games on more and more channels at once and returns
+        a report of how the event loop and the games held up.
+
+        The games run with a fake bot and a local stand-in for OTDB, with
+        every wait shortened by scale. The request budget is sped up by the
+        same amount, so sending still slows down the way it would on Discord."""
+        report = ("{} players, {} questions per game, timings x{}\n"
+                  "channels: loop lag mean/max, round time mean/max, "
+                  "memory per game, answers handled per second\n"
+                  .format(players, questions, scale))
+        baseline = None
+        for count in channel_counts:
+            result = await simulate_load(self.bot.loop, count, players, questions, scale)
+            if baseline is None:
+                baseline = result["Round"] or 1
+            report += ("{}: {:.1f}/{:.1f} ms, {:.2f}/{:.2f} s (x{:.2f}), {:.1f} KB, "
+                       "{:.0f}/s{}\n".format(count, result["Lag"] * 1000,
+                                             result["Max lag"] * 1000, result["Round"],
+                                             result["Max round"], result["Round"] / baseline,
+                                             result["Memory"] / 1024, result["Throughput"],
+                                             ", {} failed".format(result["Failed"])
+                                             if result["Failed"] else ""))
+        return report
+
+def setup(bot):
+    """Creates a QuizBench object."""
+    bot.add_cog(QuizBench(bot))